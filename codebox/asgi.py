@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'codebox.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from iac.streaming import MissionStreamApplication  # noqa: E402
+
+# /api/iac/mission/<id>/stream/ 由异步SSE处理, 其余请求交给django
+application = MissionStreamApplication(django_application)
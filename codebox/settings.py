@@ -12,6 +12,9 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 
 from pathlib import Path
 
+from kombu import Queue
+from kombu.common import Broadcast
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -50,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'iac.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'codebox.urls'
@@ -123,9 +127,125 @@ STATIC_URL = 'static/'
 MEDIA_ROOT = 'repository/'
 
 IAC_WORKDIR = '/tmp/codebox/'
+# 任务结束后保留的artifacts文件(相对artifacts/<ident>/的通配符), 其余工作目录内容立即删除
+IAC_WORKDIR_RETAIN_ARTIFACTS = ['stdout', 'status', 'rc']
+# 保留的artifacts在定时清理时超过该小时数后删除
+IAC_WORKDIR_RETAIN_HOURS = 24
+# 工作目录所在磁盘使用率高水位, 超过时清理并延迟新任务
+IAC_WORKDIR_HIGH_WATERMARK = 0.9
+# 磁盘压力清理的目标使用率
+IAC_WORKDIR_LOW_WATERMARK = 0.8
+# 磁盘压力下任务延迟执行的间隔秒
+IAC_WORKDIR_RETRY_DELAY = 60
+# 磁盘压力下任务最多延迟次数, 超过后任务失败
+IAC_WORKDIR_MAX_RETRIES = 10
+# 每个仓库在worker上预先检出最新commit的工作目录数, 0表示关闭
+IAC_WORKDIR_POOL_SIZE = 1
+# 预热最近使用的仓库数
+IAC_WORKDIR_POOL_REPOSITORIES = 10
+# 最近使用的时间范围小时数
+IAC_WORKDIR_POOL_RECENT_HOURS = 24
+
+# 仓库裸镜像缓存目录
+IAC_MIRROR_DIR = '/tmp/codebox-mirror/'
+# 仓库镜像缓存总大小上限字节, 超出后按最近使用时间淘汰
+IAC_MIRROR_MAX_SIZE = 10 * 1024 ** 3
+
+# 执行配置开启facts缓存时的后端: jsonfile或redis(需要community.general集合)
+IAC_FACT_CACHE_BACKEND = 'jsonfile'
+# jsonfile后端按仓库存放缓存的目录, api查看和清除缓存需要与worker共享该目录
+IAC_FACT_CACHE_DIR = '/tmp/codebox-facts/'
+# redis后端地址
+IAC_FACT_CACHE_REDIS = 'redis://127.0.0.1:6379/3'
+# 单个主机facts的默认过期秒数, 0表示不过期
+IAC_FACT_CACHE_TIMEOUT = 24 * 3600
+
+# 已订阅取消通知时, 运行中任务回查数据库取消状态的间隔秒
+IAC_CANCEL_POLL_INTERVAL = 10
+# 取消通知不可用时回查数据库的间隔秒
+IAC_CANCEL_FALLBACK_INTERVAL = 1
+
+# 全局同时执行的任务数上限
+IAC_MAX_CONCURRENT_MISSIONS = 16
+# 单个仓库同时执行的任务数上限
+IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY = 4
+# 每次调度扫描的排队任务数
+IAC_SCHEDULER_SCAN_LIMIT = 1000
+# 执行中任务更新心跳的间隔秒
+IAC_HEARTBEAT_INTERVAL = 30
+# 派发后超过该秒数仍未开始执行的任务重新排队, 心跳停止超过该秒数的任务视为worker已退出并置为失败
+IAC_DISPATCH_TIMEOUT = 600
+
+# celery worker导出prometheus指标的端口, 为None不导出; 同一主机运行多个worker时需分别设置
+IAC_WORKER_METRICS_PORT = 9808
+
+# 任务实时事件流最大保留条数
+IAC_STREAM_MAXLEN = 100000
+# 任务实时事件流保留时间秒
+IAC_STREAM_TTL = 24 * 3600
+# 实时事件流空闲时发送心跳的间隔秒
+IAC_STREAM_KEEPALIVE = 15
+
+# 任务事件和输出的默认保留天数, 超过后归档到文件并删除数据库记录, 为None不归档
+IAC_RETENTION_DAYS = None
+# 归档目录, 需要被worker和api共享访问
+IAC_ARCHIVE_DIR = 'archive/'
+# 归档时每批删除的记录数
+IAC_RETENTION_BATCH_SIZE = 1000
+# 每次归档每个仓库最多处理的任务数
+IAC_RETENTION_MISSIONS_PER_RUN = 100
+
+# 事件入库方式: inline在事件回调中批量写入; deferred回调只更新状态和汇总, 从artifacts的job_events文件导入
+IAC_EVENT_INGESTION = 'inline'
+# deferred模式下扫描job_events目录的间隔秒
+IAC_INGESTION_INTERVAL = 1
+
+# 批量提交单次最多任务数
+IAC_BULK_MAX_MISSIONS = 1000
+
+# 单个任务最大分片数, 每个分片占用一个执行槽位, 实际上限不超过全局和单仓库并发上限
+IAC_MAX_SHARDS = 32
+
+# 任务事件批量写入条数
+IAC_EVENT_BATCH_SIZE = 200
+# 任务事件最长缓冲时间秒
+IAC_EVENT_FLUSH_INTERVAL = 2
+# 任务结束时写入事件失败的重试次数, 重试间隔从该秒数开始倍增
+IAC_EVENT_FLUSH_RETRIES = 3
+IAC_EVENT_FLUSH_RETRY_DELAY = 1
+
+# 任务输出分块大小字节
+IAC_OUTPUT_CHUNK_SIZE = 64 * 1024
+# 任务输出分块是否压缩
+IAC_OUTPUT_COMPRESS = True
+# 单次读取任务输出的最大字节数
+IAC_OUTPUT_READ_LIMIT = 1024 * 1024
+
+# keyset分页总数缓存时间秒
+IAC_PAGINATION_COUNT_CACHE_TTL = 60
 
 # token过期时间秒
 TOKEN_ACTIVE_TIME = 3600
+# token校验共享缓存, 为None时只使用进程内缓存
+IAC_TOKEN_CACHE_ALIAS = 'iac'
+# token校验缓存最长时间秒, 同时不超过token过期时间
+IAC_TOKEN_CACHE_TTL = 300
+# 进程内token缓存时间秒, 注销和停用用户只能立即清除当前进程的本地缓存, 多进程部署时其他进程最多延迟该时间生效
+IAC_TOKEN_CACHE_LOCAL_TTL = 10
+# 进程内token缓存条数
+IAC_TOKEN_CACHE_SIZE = 1024
+# 批量清理过期数据每批条数
+IAC_PURGE_BATCH_SIZE = 1000
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'iac': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/2',
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
@@ -179,3 +299,39 @@ SPECTACULAR_SETTINGS = {
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/1'
 CELERY_TIMEZONE = "Asia/Shanghai"
 CELERY_RESULT_BACKEND = 'django-db'
+# 清理本机工作目录等只作用于本机磁盘的定时任务通过广播队列发给每个worker, 普通队列只会被任意一个worker消费
+CELERY_TASK_QUEUES = (
+    Queue('celery'),
+    Broadcast('codebox.workers'),
+)
+CELERY_TASK_ROUTES = {
+    'iac.tasks.sweep_workdirs': {'queue': 'codebox.workers', 'exchange': 'codebox.workers'},
+    'iac.tasks.evict_mirrors': {'queue': 'codebox.workers', 'exchange': 'codebox.workers'},
+    'iac.tasks.refresh_workdir_pool': {'queue': 'codebox.workers', 'exchange': 'codebox.workers'},
+}
+CELERY_BEAT_SCHEDULE = {
+    'archive-missions': {
+        'task': 'iac.tasks.archive_missions',
+        'schedule': 3600,
+    },
+    'dispatch-missions': {
+        'task': 'iac.tasks.dispatch',
+        'schedule': 10,
+    },
+    'sweep-workdirs': {
+        'task': 'iac.tasks.sweep_workdirs',
+        'schedule': 600,
+    },
+    'evict-mirrors': {
+        'task': 'iac.tasks.evict_mirrors',
+        'schedule': 600,
+    },
+    'refresh-workdir-pool': {
+        'task': 'iac.tasks.refresh_workdir_pool',
+        'schedule': 300,
+    },
+    'purge-authorizations': {
+        'task': 'iac.tasks.purge_authorizations',
+        'schedule': 3600,
+    },
+}
@@ -17,9 +17,13 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
 
+from iac.metrics import export
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/iac/', include("iac.urls")),
+    # 多进程部署的api需设置相同的PROMETHEUS_MULTIPROC_DIR环境变量, worker指标见IAC_WORKER_METRICS_PORT
+    path('metrics', export, name='metrics'),
 
     path('doc/spec/', SpectacularAPIView.as_view(), name='spec'),
     path('doc/swagger/', SpectacularSwaggerView.as_view(url_name='spec'), name='swagger-ui'),
@@ -7,3 +7,5 @@ class IacConfig(AppConfig):
 
     def ready(self):
         super(IacConfig, self).ready()
+        # 注册token缓存失效的信号处理
+        from . import authentication  # noqa: F401
@@ -0,0 +1,106 @@
+import gzip
+import json
+import logging
+import os
+import pathlib
+import zlib
+from datetime import timedelta
+from typing import Iterator
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import serializers
+from .models import Mission, MissionEvent, MissionOutputChunk, Repository, FINISHED_STATES
+
+logger = logging.getLogger(__name__)
+
+
+def archive_dir(mission: Mission) -> pathlib.Path:
+    return pathlib.Path(settings.IAC_ARCHIVE_DIR, str(mission.id // 1000))
+
+
+def events_path(mission: Mission) -> pathlib.Path:
+    return archive_dir(mission).joinpath(f"{mission.id}.events.jsonl.gz")
+
+
+def output_path(mission: Mission) -> pathlib.Path:
+    return archive_dir(mission).joinpath(f"{mission.id}.output.gz")
+
+
+# 归档文件: events为gzip json lines, 首行为元信息; output为gzip压缩的原始输出
+def archive(mission: Mission):
+    if mission.archived_at is None:
+        archive_dir(mission).mkdir(parents=True, exist_ok=True)
+        output_tmp = output_path(mission).with_suffix(".tmp")
+        size = 0
+        with gzip.open(output_tmp, "wb") as writer:
+            if mission.output:
+                size += writer.write(mission.output.encode())
+            for chunk in MissionOutputChunk.objects.filter(mission=mission).order_by("seq").iterator():
+                size += writer.write(zlib.decompress(chunk.data) if chunk.compressed else bytes(chunk.data))
+
+        events_tmp = events_path(mission).with_suffix(".tmp")
+        events = MissionEvent.objects.filter(mission=mission).order_by("id")
+        with gzip.open(events_tmp, "wt") as writer:
+            writer.write(json.dumps({"output_size": size, "events": events.count()}) + "\n")
+            for event in events.iterator(chunk_size=settings.IAC_RETENTION_BATCH_SIZE):
+                writer.write(json.dumps(serializers.MissionEventSerializer(event).data) + "\n")
+
+        os.replace(output_tmp, output_path(mission))
+        os.replace(events_tmp, events_path(mission))
+        mission.archived_at = timezone.now()
+        mission.output = None
+        mission.save(update_fields=["archived_at", "output"])
+
+    # 小批量删除, 避免长事务; 中途失败时重新执行会继续删除
+    for model in (MissionEvent, MissionOutputChunk):
+        while True:
+            ids = list(model.objects.filter(mission=mission)
+                       .values_list("id", flat=True)[:settings.IAC_RETENTION_BATCH_SIZE])
+            if not ids:
+                break
+            model.objects.filter(id__in=ids).delete()
+
+
+def expired_missions() -> Iterator[Mission]:
+    now = timezone.now()
+    for repository in Repository.objects.all():
+        days = repository.retention_days
+        if days is None:
+            days = settings.IAC_RETENTION_DAYS
+        if not days:
+            continue
+        yield from Mission.objects.filter(repository=repository, archived_at__isnull=True,
+                                          state__in=FINISHED_STATES, created_at__lt=now - timedelta(days=days)) \
+            .order_by("id")[:settings.IAC_RETENTION_MISSIONS_PER_RUN]
+
+
+def read_meta(mission: Mission) -> dict:
+    with gzip.open(events_path(mission), "rt") as reader:
+        return json.loads(reader.readline())
+
+
+def read_events(mission: Mission) -> Iterator[dict]:
+    with gzip.open(events_path(mission), "rt") as reader:
+        reader.readline()
+        for line in reader:
+            yield json.loads(line)
+
+
+def count_events(mission: Mission) -> dict:
+    counts = {"total": 0, "hosts": set(), "changed": 0, "states": {}}
+    for event in read_events(mission):
+        counts["total"] += 1
+        counts["hosts"].add(event["host"])
+        counts["changed"] += event["changed"]
+        counts["states"][event["state"]] = counts["states"].get(event["state"], 0) + 1
+    counts["hosts"] = len(counts["hosts"])
+    return counts
+
+
+def read_output(mission: Mission, offset: int, end: int) -> bytes:
+    # gzip不支持随机访问, 顺序解压跳过offset之前的内容
+    with gzip.open(output_path(mission), "rb") as reader:
+        reader.seek(offset)
+        return reader.read(end - offset)
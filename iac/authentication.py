@@ -1,4 +1,13 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from drf_spectacular.extensions import OpenApiAuthenticationExtension
 from rest_framework.authentication import BaseAuthentication
@@ -7,6 +16,97 @@ from rest_framework.request import Request
 
 from .models import Authorization
 
+logger = logging.getLogger(__name__)
+
+
+# token校验缓存: 进程内LRU + 可选的共享缓存(如redis), 过期时间不超过token的expired_at
+# 共享缓存只保存用户id, 命中后按主键加载用户, 不把用户对象(含密码哈希)写入redis
+class TokenCache:
+    prefix = "iac:token:"
+
+    def __init__(self):
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        alias = settings.IAC_TOKEN_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def get(self, token: str):
+        now = time.time()
+        with self.lock:
+            item = self.local.get(token)
+            if item is not None:
+                if item[0] > now:
+                    self.local.move_to_end(token)
+                    return item[1]
+                del self.local[token]
+        if self.shared is None:
+            return None
+        try:
+            user_id = self.shared.get(self.prefix + token)
+        except Exception as e:
+            logger.warning("get token cache failed: %s", e)
+            return None
+        if user_id is None:
+            return None
+        user = User.objects.filter(id=user_id).first()
+        if user is not None:
+            self.set_local(token, user, settings.IAC_TOKEN_CACHE_LOCAL_TTL)
+        return user
+
+    def set(self, token: str, user, expired_at):
+        ttl = min(expired_at.timestamp() - time.time(), settings.IAC_TOKEN_CACHE_TTL)
+        if ttl <= 0:
+            return
+        self.set_local(token, user, min(ttl, settings.IAC_TOKEN_CACHE_LOCAL_TTL))
+        if self.shared is None:
+            return
+        try:
+            self.shared.set(self.prefix + token, user.id, ttl)
+        except Exception as e:
+            logger.warning("set token cache failed: %s", e)
+
+    def set_local(self, token: str, user, ttl):
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.local[token] = (time.time() + ttl, user)
+            self.local.move_to_end(token)
+            while len(self.local) > settings.IAC_TOKEN_CACHE_SIZE:
+                self.local.popitem(last=False)
+
+    def invalidate(self, *tokens: str):
+        with self.lock:
+            for token in tokens:
+                self.local.pop(token, None)
+        if self.shared is None or not tokens:
+            return
+        try:
+            self.shared.delete_many([self.prefix + token for token in tokens])
+        except Exception as e:
+            logger.warning("invalidate token cache failed: %s", e)
+
+
+token_cache = TokenCache()
+
+
+# 缓存中保存了用户对象, 用户变更(如停用)或token删除(注销, 删除用户时级联删除)时立即失效
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance: User, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) == {"last_login"}:
+        return
+    token_cache.invalidate(*Authorization.objects.filter(user=instance, expired_at__gte=timezone.now())
+                           .values_list("token", flat=True))
+
+
+@receiver(post_delete, sender=Authorization)
+def invalidate_token(sender, instance: Authorization, **kwargs):
+    # 已过期的token不会在缓存中
+    if instance.expired_at >= timezone.now():
+        token_cache.invalidate(instance.token)
+
 
 class BearerTokenAuthentication(BaseAuthentication):
     prefix = "bearer"
@@ -23,12 +123,20 @@ class BearerTokenAuthentication(BaseAuthentication):
         if not token.startswith(self.prefix):
             return None
         token = token[len(self.prefix):].strip()
-        try:
-            authorization = Authorization.objects.filter(token=token, expired_at__gte=timezone.now()).get()
-            if authorization.user.is_active:
-                return authorization.user, token
-        except Authorization.DoesNotExist:
-            pass
+        return self.authenticate_credentials(token)
+
+    def authenticate_credentials(self, token: str):
+        user = token_cache.get(token)
+        if user is None:
+            try:
+                authorization = Authorization.objects.select_related("user") \
+                    .filter(token=token, expired_at__gte=timezone.now()).get()
+            except Authorization.DoesNotExist:
+                raise AuthenticationFailed("authentication failed")
+            user = authorization.user
+            token_cache.set(token, user, authorization.expired_at)
+        if user.is_active:
+            return user, token
         raise AuthenticationFailed("authentication failed")
 
 
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+import redis
+from django.conf import settings
+
+from . import metrics
+from .broker import client
+
+logger = logging.getLogger(__name__)
+
+# 本进程内运行中任务的取消标记
+_signals: dict[int, "CancelSignal"] = {}
+
+
+def channel(mission_id) -> str:
+    return f"codebox:mission:{mission_id}:cancel"
+
+
+def publish(mission_id):
+    signal = _signals.get(mission_id)
+    if signal is not None:
+        signal.flag.set()
+    try:
+        client().publish(channel(mission_id), 1)
+    except redis.RedisError as e:
+        logger.warning("publish cancel of mission %s failed: %s", mission_id, e)
+
+
+# 运行中的任务订阅取消通知, 只检查内存标记, 数据库作为限频兜底
+class CancelSignal:
+    def __init__(self, mission_id, check: Callable[[], bool]):
+        self.mission_id = mission_id
+        self.check = check
+        self.flag = threading.Event()
+        self.poll_interval = settings.IAC_CANCEL_FALLBACK_INTERVAL
+        self.checked_at = None
+        self.pubsub = None
+        self.thread = None
+
+    def start(self):
+        _signals[self.mission_id] = self
+        try:
+            self.pubsub = client().pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(**{channel(self.mission_id): lambda message: self.flag.set()})
+            self.thread = self.pubsub.run_in_thread(sleep_time=0.5, daemon=True,
+                                                    exception_handler=self.on_error)
+            self.poll_interval = settings.IAC_CANCEL_POLL_INTERVAL
+        except redis.RedisError as e:
+            logger.warning("subscribe cancel of mission %s failed, fallback to polling: %s", self.mission_id, e)
+            self.pubsub = None
+
+    def on_error(self, e, pubsub, thread):
+        logger.warning("cancel subscription of mission %s lost, fallback to polling: %s", self.mission_id, e)
+        self.poll_interval = settings.IAC_CANCEL_FALLBACK_INTERVAL
+        thread.stop()
+
+    def is_set(self) -> bool:
+        if self.flag.is_set():
+            return True
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.poll_interval:
+            self.checked_at = now
+            metrics.CANCEL_POLLS.inc()
+            if self.check():
+                self.flag.set()
+        return self.flag.is_set()
+
+    def stop(self):
+        _signals.pop(self.mission_id, None)
+        try:
+            if self.thread is not None:
+                self.thread.stop()
+            if self.pubsub is not None:
+                self.pubsub.close()
+        except redis.RedisError:
+            pass
@@ -0,0 +1,29 @@
+from django.db import connections, router
+
+
+# 单条语句批量插入或更新, mysql使用ON DUPLICATE KEY UPDATE, 其余使用ON CONFLICT DO UPDATE
+def upsert(model, objs: list, unique_fields: list[str], update_fields: list[str], batch_size: int = 500):
+    if not objs:
+        return
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [field for field in opts.concrete_fields if not field.primary_key]
+    columns = ", ".join(qn(field.column) for field in fields)
+    updates = [opts.get_field(name).column for name in update_fields]
+    if connection.vendor == "mysql":
+        conflict = "ON DUPLICATE KEY UPDATE " + ", ".join(f"{qn(c)} = VALUES({qn(c)})" for c in updates)
+    else:
+        targets = ", ".join(qn(opts.get_field(name).column) for name in unique_fields)
+        conflict = f"ON CONFLICT ({targets}) DO UPDATE SET " + \
+                   ", ".join(f"{qn(c)} = EXCLUDED.{qn(c)}" for c in updates)
+    row = "(" + ", ".join(["%s"] * len(fields)) + ")"
+
+    with connection.cursor() as cursor:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            params = []
+            for obj in batch:
+                params.extend(field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields)
+            cursor.execute(f"INSERT INTO {qn(opts.db_table)} ({columns}) VALUES {', '.join([row] * len(batch))} "
+                           f"{conflict}", params)
@@ -0,0 +1,141 @@
+import json
+import logging
+import pathlib
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import streaming
+from .db import upsert
+from .models import Mission, MissionEvent
+
+logger = logging.getLogger(__name__)
+
+
+# 缓冲写入ansible-runner事件, 按数量或时间批量落库
+class EventWriter:
+    fields = ["state", "play", "play_pattern", "task", "task_action", "task_args",
+              "res", "start", "end", "duration", "changed"]
+
+    def __init__(self, mission: Mission, spill_dir: pathlib.Path = None):
+        self.mission = mission
+        # 最终写入失败时转存事件的目录, 格式同ansible-runner的job_events, 由ingestion.recover重新导入
+        self.spill_dir = spill_dir
+        self.batch_size = settings.IAC_EVENT_BATCH_SIZE
+        self.flush_interval = settings.IAC_EVENT_FLUSH_INTERVAL
+        self.pending: dict[tuple[str, str], MissionEvent] = {}
+        self.flushed_at = time.monotonic()
+        self.lock = threading.RLock()
+
+    def write(self, event: dict):
+        model = self.build(event)
+        with self.lock:
+            self.pending[(str(model.uuid), model.host)] = model
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+
+    def build(self, event: dict) -> MissionEvent:
+        data = event["event_data"]
+        res = data.get("res", {})
+        model = MissionEvent(
+            mission=self.mission,
+            uuid=event["parent_uuid"],
+            host=data["host"],
+            state=event["event"].removeprefix("runner_on_"),
+            play=data["play"],
+            play_pattern=data["play_pattern"],
+            task=data["task"],
+            task_action=data["task_action"],
+            task_args=data["task_args"],
+            res=res,
+            duration=data.get("duration"),
+            changed=res.get("changed", False),
+        )
+        dt = data.get("start")
+        if dt:
+            model.start = timezone.make_aware(datetime.fromisoformat(dt))
+        dt = data.get("end")
+        if dt:
+            model.end = timezone.make_aware(datetime.fromisoformat(dt))
+        return model
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.monotonic()
+            if not pending:
+                return
+            try:
+                self.save(pending)
+            except Exception:
+                # 写入失败时放回缓冲区, 不覆盖期间到达的更新状态
+                for key, model in pending.items():
+                    self.pending.setdefault(key, model)
+                raise
+
+    def save(self, pending: dict[tuple[str, str], MissionEvent]):
+        # 同一事件的后续状态(如start之后的ok)覆盖已写入的记录
+        upsert(MissionEvent, list(pending.values()), unique_fields=["mission", "uuid", "host"],
+               update_fields=self.fields, batch_size=self.batch_size)
+        streaming.publish(self.mission.id, [("event", self.summarize(model)) for model in pending.values()])
+
+    def summarize(self, model: MissionEvent) -> dict:
+        return {
+            "uuid": model.uuid,
+            "host": model.host,
+            "state": model.state,
+            "play": model.play,
+            "task": model.task,
+            "changed": model.changed,
+            "duration": model.duration,
+        }
+
+    def dump(self, model: MissionEvent) -> dict:
+        # build的逆过程
+        data = {
+            "host": model.host,
+            "play": model.play,
+            "play_pattern": model.play_pattern,
+            "task": model.task,
+            "task_action": model.task_action,
+            "task_args": model.task_args,
+            "res": model.res,
+            "duration": model.duration,
+        }
+        if model.start:
+            data["start"] = timezone.make_naive(model.start).isoformat()
+        if model.end:
+            data["end"] = timezone.make_naive(model.end).isoformat()
+        return {"event": f"runner_on_{model.state}", "parent_uuid": str(model.uuid), "event_data": data}
+
+    def spill(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        path = self.spill_dir.joinpath("artifacts", "spill", "job_events")
+        path.mkdir(parents=True, exist_ok=True)
+        for counter, model in enumerate(pending.values(), 1):
+            path.joinpath(f"{counter}-{uuid.uuid4()}.json").write_text(json.dumps(self.dump(model)))
+        logger.warning("spill %d events of mission %s to %s", len(pending), self.mission.id, path)
+
+    def close(self) -> bool:
+        # 任务结束时必须写完, 失败时退避重试, 仍失败则转存到工作目录; 返回事件是否都已入库
+        retries = settings.IAC_EVENT_FLUSH_RETRIES
+        for attempt in range(retries + 1):
+            try:
+                self.flush()
+                return True
+            except Exception:
+                logger.exception("flush events of mission %s failed", self.mission.id)
+            if attempt < retries:
+                time.sleep(settings.IAC_EVENT_FLUSH_RETRY_DELAY * 2 ** attempt)
+        if self.spill_dir is None:
+            return False
+        try:
+            self.spill()
+        except OSError:
+            logger.exception("spill events of mission %s failed", self.mission.id)
+        return False
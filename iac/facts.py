@@ -0,0 +1,135 @@
+import json
+import pathlib
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Repository
+
+_client = None
+
+# ansible-core 2.19起缓存键带有版本前缀
+KEY_PREFIXES = ("", "s1_")
+
+
+def client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.IAC_FACT_CACHE_REDIS)
+    return _client
+
+
+# 按仓库隔离的ansible facts缓存, jsonfile存放在本地目录, redis后端由各worker共享
+class FactCache:
+    def __init__(self, repository: Repository, timeout: int = None):
+        self.repository = repository
+        self.backend = settings.IAC_FACT_CACHE_BACKEND
+        self.timeout = settings.IAC_FACT_CACHE_TIMEOUT if timeout is None else timeout
+        self.path = pathlib.Path(settings.IAC_FACT_CACHE_DIR, str(repository.id))
+        self.prefix = f"codebox:facts:{repository.id}:"
+        self.keyset = f"codebox:facts:{repository.id}:keys"
+
+    def run_options(self) -> dict:
+        # ansible-runner默认把jsonfile缓存放在artifacts中, 通过fact_cache指定为共享目录, 其他后端需改变fact_cache_type
+        if self.backend == "redis":
+            return {"fact_cache_type": "redis", "envvars": self.envvars()}
+        return {"fact_cache_type": "jsonfile", "fact_cache": str(self.path), "envvars": self.envvars()}
+
+    def envvars(self) -> dict:
+        if self.backend == "redis":
+            url = urlparse(settings.IAC_FACT_CACHE_REDIS)
+            connection = f"{url.hostname}:{url.port or 6379}:{url.path.strip('/') or 0}"
+            if url.password:
+                connection += f":{url.password}"
+            envvars = {
+                "ANSIBLE_CACHE_PLUGIN": "community.general.redis",
+                "ANSIBLE_CACHE_PLUGIN_CONNECTION": connection,
+                "ANSIBLE_CACHE_PLUGIN_PREFIX": self.prefix,
+                "ANSIBLE_CACHE_REDIS_KEYSET_NAME": self.keyset,
+            }
+        else:
+            envvars = {
+                "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+                "ANSIBLE_CACHE_PLUGIN_CONNECTION": str(self.path),
+            }
+        envvars["ANSIBLE_CACHE_PLUGIN_TIMEOUT"] = str(self.timeout)
+        return envvars
+
+    def expired(self, updated_at: float) -> bool:
+        return bool(self.timeout) and time.time() - updated_at > self.timeout
+
+    def file(self, host: str) -> pathlib.Path | None:
+        if not host or "/" in host or host.startswith("."):
+            return None
+        return self.path.joinpath(host)
+
+    def hosts(self) -> list[dict]:
+        if self.backend == "redis":
+            entries = client().zrangebyscore(self.keyset, time.time() - self.timeout if self.timeout else "-inf",
+                                             "+inf", withscores=True)
+            entries = [(key.decode(), updated_at) for key, updated_at in entries]
+        elif self.path.is_dir():
+            entries = [(path.name, path.stat().st_mtime) for path in self.path.iterdir()
+                       if not path.name.startswith(".")]
+        else:
+            entries = []
+        hosts = {}
+        for key, updated_at in entries:
+            if not self.expired(updated_at):
+                host = self.host(key)
+                hosts[host] = max(hosts.get(host, 0), updated_at)
+        return [{"host": host, "updated_at": datetime.fromtimestamp(updated_at, tz=timezone.utc)}
+                for host, updated_at in sorted(hosts.items())]
+
+    @staticmethod
+    def host(key: str) -> str:
+        for prefix in KEY_PREFIXES:
+            if prefix and key.startswith(prefix):
+                return key[len(prefix):]
+        return key
+
+    def get(self, host: str) -> dict | None:
+        for key in (prefix + host for prefix in KEY_PREFIXES):
+            if self.backend == "redis":
+                updated_at = client().zscore(self.keyset, key)
+                value = client().get(self.prefix + key)
+            else:
+                path = self.file(key)
+                if path is None or not path.is_file():
+                    continue
+                updated_at = path.stat().st_mtime
+                value = path.read_text()
+            if value is not None and updated_at is not None and not self.expired(updated_at):
+                return {"host": host, "updated_at": datetime.fromtimestamp(updated_at, tz=timezone.utc),
+                        "facts": json.loads(value)}
+        return None
+
+    def delete(self, *hosts: str) -> int:
+        keys = [prefix + host for host in hosts for prefix in KEY_PREFIXES]
+        if not keys:
+            return 0
+        if self.backend == "redis":
+            pipe = client().pipeline()
+            pipe.delete(*[self.prefix + key for key in keys])
+            pipe.zrem(self.keyset, *keys)
+            return pipe.execute()[0]
+        count = 0
+        for key in keys:
+            path = self.file(key)
+            if path is not None and path.is_file():
+                path.unlink(missing_ok=True)
+                count += 1
+        return count
+
+    def flush(self) -> int:
+        if self.backend == "redis":
+            keys = [key.decode() for key in client().zrange(self.keyset, 0, -1)]
+        elif self.path.is_dir():
+            keys = [path.name for path in self.path.iterdir() if not path.name.startswith(".")]
+        else:
+            keys = []
+        return self.delete(*{self.host(key) for key in keys})
@@ -0,0 +1,93 @@
+import json
+import logging
+import pathlib
+import threading
+
+from django.conf import settings
+
+from . import workdir
+from .events import EventWriter
+from .models import Mission, MissionMode, FINISHED_STATES
+
+logger = logging.getLogger(__name__)
+
+
+def counter(path: pathlib.Path) -> int:
+    # job_events文件名为<counter>-<uuid>.json
+    return int(path.name.split("-", 1)[0])
+
+
+# 从ansible-runner写出的artifacts/<ident>/job_events批量导入事件, 入库按事件标识幂等, 可重复执行
+class ArtifactIngester:
+    def __init__(self, mission: Mission, workdir: pathlib.Path):
+        self.mission = mission
+        self.workdir = workdir
+        self.writer = EventWriter(mission)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(settings.IAC_INGESTION_INTERVAL):
+            try:
+                self.ingest()
+            except Exception:
+                logger.exception("ingest events of mission %s failed", self.mission.id)
+
+    def files(self) -> list[pathlib.Path]:
+        paths = [path for path in self.workdir.glob("artifacts/*/job_events/*.json")
+                 if not path.name.endswith("-partial.json")]
+        return sorted(paths, key=counter)
+
+    def ingest(self):
+        with self.lock:
+            ingested = []
+            for path in self.files():
+                try:
+                    event = json.loads(path.read_text())
+                except (OSError, ValueError) as e:
+                    logger.warning("read event %s failed: %s", path, e)
+                    continue
+                ingested.append(path)
+                if event.get("event", "").startswith("runner_on"):
+                    self.writer.write(event)
+            self.writer.flush()
+            # 入库后删除已导入的文件, 每次只扫描新写出的事件; 写入失败时保留文件, 下次重新读取
+            for path in ingested:
+                path.unlink(missing_ok=True)
+
+    def stop(self) -> bool:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.ingest()
+            return True
+        except Exception:
+            logger.exception("ingest events of mission %s failed", self.mission.id)
+            return False
+
+
+# 补做异常退出时未完成的导入: 重新导入本机带标记且已结束任务的job_events, 成功后清理工作目录
+def recover() -> int:
+    if not workdir.root().exists():
+        return 0
+    marked = {int(p.name): p for p in workdir.root().iterdir()
+              if p.name.isdigit() and p.is_dir() and workdir.ingestion_pending(p)}
+    missions = Mission.objects.filter(id__in=marked, state__in=FINISHED_STATES).select_related("parent")
+    recovered = 0
+    for mission in missions:
+        event_mission = mission.parent if mission.mode == MissionMode.SHARD else mission
+        try:
+            ArtifactIngester(event_mission, marked[mission.id]).ingest()
+            workdir.cleanup(mission.id)
+            recovered += 1
+        except Exception:
+            logger.exception("recover events of mission %s failed", mission.id)
+    if recovered:
+        logger.info("recovered events of %d missions", recovered)
+    return recovered
@@ -0,0 +1,186 @@
+import json
+import pathlib
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from iac.models import Repository, Mission, MissionEvent, MissionState
+from iac.runner import Runner
+from iac.summary import SummaryCollector
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[round(p * (len(values) - 1))] if values else 0
+
+
+def report(latencies: list[float], elapsed: float, queries: int, count: int) -> dict:
+    return {
+        "throughput": count / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "queries": queries / count if count else 0,
+    }
+
+
+def synthetic_events(hosts: int, tasks: int) -> list[dict]:
+    events = [{"event": "playbook_on_start", "uuid": str(uuid.uuid4()), "event_data": {}}]
+    stats = {"ok": {}, "changed": {}}
+    for t in range(tasks):
+        task_uuid = str(uuid.uuid4())
+        data = {"play": "benchmark", "play_pattern": "all", "task": f"task{t}",
+                "task_action": "ansible.builtin.command", "task_args": ""}
+        events.append({"event": "playbook_on_task_start", "uuid": task_uuid, "stdout": f"TASK [task{t}] ***",
+                       "event_data": data})
+        for h in range(hosts):
+            host = f"host{h}"
+            start = datetime.now()
+            end = start + timedelta(milliseconds=50)
+            events.append({"event": "runner_on_start", "uuid": str(uuid.uuid4()), "parent_uuid": task_uuid,
+                           "event_data": dict(data, host=host, start=start.isoformat())})
+            events.append({"event": "runner_on_ok", "uuid": str(uuid.uuid4()), "parent_uuid": task_uuid,
+                           "stdout": f"changed: [{host}]",
+                           "event_data": dict(data, host=host, start=start.isoformat(), end=end.isoformat(),
+                                              duration=0.05, res={"changed": True, "rc": 0, "stdout": "ok"})})
+            stats["ok"][host] = stats["ok"].get(host, 0) + 1
+            stats["changed"][host] = stats["changed"].get(host, 0) + 1
+    events.append({"event": "playbook_on_stats", "uuid": str(uuid.uuid4()), "event_data": stats})
+    return events
+
+
+def recorded_events(path: pathlib.Path) -> list[dict]:
+    # ansible-runner的artifacts/<ident>/job_events目录, 或每行一个事件的jsonl文件
+    if path.is_dir():
+        events = [json.loads(p.read_text()) for p in path.glob("*.json")]
+        return sorted(events, key=lambda event: event.get("counter", 0))
+    with open(path) as reader:
+        return [json.loads(line) for line in reader if line.strip()]
+
+
+# 在临时测试库上回放事件流和压测任务列表/详情接口, 不运行ansible
+class Command(BaseCommand):
+    help = "Benchmark the event pipeline and mission API on a temporary test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hosts", type=int, default=50, help="hosts of synthetic event stream")
+        parser.add_argument("--tasks", type=int, default=20, help="tasks of synthetic event stream")
+        parser.add_argument("--events", type=pathlib.Path,
+                            help="replay recorded events from a job_events directory or jsonl file")
+        parser.add_argument("--missions", type=int, default=500, help="missions seeded for api benchmark")
+        parser.add_argument("--requests", type=int, default=200, help="requests per api endpoint")
+        parser.add_argument("--save", type=pathlib.Path, help="write results to a json file")
+        parser.add_argument("--baseline", type=pathlib.Path, help="compare results with a saved json file")
+        parser.add_argument("--tolerance", type=float, default=0.1,
+                            help="allowed relative regression against baseline")
+
+    def handle(self, *args, hosts, tasks, events, missions, requests, save, baseline, tolerance, **options):
+        setup_test_environment()
+        name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = {"events": self.bench_events(recorded_events(events) if events
+                                                   else synthetic_events(hosts, tasks))}
+            results.update(self.bench_api(missions, requests))
+        finally:
+            connection.creation.destroy_test_db(name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            self.stdout.write(f"{name:<24} {result['throughput']:>10.1f}/s  p50 {result['p50_ms']:>8.3f}ms  "
+                              f"p99 {result['p99_ms']:>8.3f}ms  queries {result['queries']:.3f}")
+        if save:
+            save.write_text(json.dumps(results, indent=2))
+        if baseline:
+            self.compare(results, json.loads(baseline.read_text()), tolerance)
+
+    def bench_events(self, events: list[dict]) -> dict:
+        user = User.objects.create_user("benchmark")
+        repository = Repository.objects.create(name="benchmark", url="https://example.com/benchmark.git",
+                                               created_by=user)
+        mission = Mission.objects.create(repository=repository, playbook="playbook.yaml", created_by=user)
+        runner = Runner(mission)
+        latencies = []
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            runner.on_status({"status": "running"}, None)
+            for event in events:
+                t = time.perf_counter()
+                runner.on_event(event)
+                latencies.append(time.perf_counter() - t)
+            runner.on_status({"status": "successful"}, None)
+            # 计入结束时写出缓冲的耗时
+            runner.events.close()
+            runner.summary.close()
+            runner.output.close()
+            elapsed = time.perf_counter() - started
+        return report(latencies, elapsed, len(queries), len(events))
+
+    def bench_api(self, missions: int, requests: int) -> dict:
+        admin = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        repositories = [Repository.objects.create(name=f"repository{i}", url="https://example.com/repo.git",
+                                                  created_by=admin) for i in range(10)]
+        objs = [Mission(repository=repositories[i % len(repositories)], playbook="playbook.yaml",
+                        state=MissionState.COMPLETED, created_by=admin) for i in range(missions)]
+        Mission.objects.bulk_create(objs, batch_size=500)
+        mission = Mission.objects.order_by("-id").first()
+        collector = SummaryCollector(mission)
+        for event in synthetic_events(10, 5):
+            collector.add(event)
+        collector.flush()
+        MissionEvent.objects.bulk_create([
+            MissionEvent(mission=mission, state="ok", uuid=uuid.uuid4(), host=f"host{i}", play="benchmark",
+                         play_pattern="all", task="ping", task_action="ping", task_args="", res={"changed": False})
+            for i in range(100)])
+
+        client = APIClient()
+        client.force_authenticate(admin)
+        endpoints = {
+            "mission.list": "/api/iac/mission/",
+            "mission.list.keyset": "/api/iac/mission/?cursor=&count=false",
+            "mission.retrieve": f"/api/iac/mission/{mission.id}/",
+            "mission.retrieve.summary": f"/api/iac/mission/{mission.id}/?summary=true",
+            "mission.events": f"/api/iac/mission/{mission.id}/events/",
+        }
+        results = {}
+        for name, path in endpoints.items():
+            client.get(path)
+            latencies = []
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                for _ in range(requests):
+                    t = time.perf_counter()
+                    response = client.get(path)
+                    latencies.append(time.perf_counter() - t)
+                    if response.status_code != 200:
+                        raise CommandError(f"{path} returned {response.status_code}: {response.content[:200]}")
+                elapsed = time.perf_counter() - started
+            results[name] = report(latencies, elapsed, len(queries), requests)
+        return results
+
+    def compare(self, results: dict, baseline: dict, tolerance: float):
+        regressions = []
+        for name, result in results.items():
+            base = baseline.get(name)
+            if base is None:
+                continue
+            changes = []
+            for key, lower_is_better in (("throughput", False), ("p50_ms", True), ("p99_ms", True),
+                                         ("queries", True)):
+                if not base[key]:
+                    continue
+                change = (result[key] - base[key]) / base[key]
+                changes.append(f"{key} {change:+.1%}")
+                worse = change > tolerance if lower_is_better else change < -tolerance
+                # 查询数是确定值, 任何增加都视为退化
+                if key == "queries":
+                    worse = result[key] > base[key]
+                if worse:
+                    regressions.append(f"{name} {key}")
+            self.stdout.write(f"{name:<24} " + "  ".join(changes))
+        if regressions:
+            raise CommandError("regression against baseline: " + ", ".join(regressions))
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count, Max
+
+from iac.models import MissionEvent
+
+IDENTITY_INDEX = "iac_missionevent_identity"
+
+
+# 为已有的大表添加(mission, uuid, host)唯一约束前, 按任务分批删除重复事件, 避免长事务和长时间锁表
+class Command(BaseCommand):
+    help = "Remove duplicated mission events in small batches and optionally add the identity unique index online"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="missions scanned per batch")
+        parser.add_argument("--sleep", type=float, default=0.1, help="seconds to sleep between batches")
+        parser.add_argument("--add-index", action="store_true",
+                            help="add the unique index with ALGORITHM=INPLACE, LOCK=NONE on mysql; the migration "
+                                 "generated by `makemigrations iac` for the constraint must then be applied with "
+                                 "`migrate iac --fake` because the index already exists")
+
+    def handle(self, *args, batch_size, sleep, add_index, **options):
+        last_id, deleted = 0, 0
+        while True:
+            mission_ids = list(MissionEvent.objects.filter(mission_id__gt=last_id).order_by("mission_id")
+                               .values_list("mission_id", flat=True).distinct()[:batch_size])
+            if not mission_ids:
+                break
+            last_id = mission_ids[-1]
+            duplicates = MissionEvent.objects.filter(mission_id__in=mission_ids) \
+                .values("mission_id", "uuid", "host").annotate(count=Count("id"), keep=Max("id")) \
+                .filter(count__gt=1).order_by()
+            for row in duplicates:
+                count, _ = MissionEvent.objects.filter(mission_id=row["mission_id"], uuid=row["uuid"],
+                                                       host=row["host"]).exclude(id=row["keep"]).delete()
+                deleted += count
+            self.stdout.write(f"scanned missions up to {last_id}, deleted {deleted} duplicated events")
+            time.sleep(sleep)
+
+        if add_index:
+            if connection.vendor != "mysql":
+                self.stderr.write("--add-index only supports mysql, run `makemigrations iac` and `migrate iac` "
+                                  "to add the constraint instead")
+                return
+            with connection.cursor() as cursor:
+                cursor.execute(f"ALTER TABLE {MissionEvent._meta.db_table} "
+                               f"ADD UNIQUE INDEX {IDENTITY_INDEX} (mission_id, uuid, host), "
+                               f"ALGORITHM=INPLACE, LOCK=NONE")
+            self.stdout.write(f"unique index {IDENTITY_INDEX} added")
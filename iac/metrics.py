@@ -0,0 +1,118 @@
+import logging
+import os
+import time
+
+import redis
+from celery.signals import worker_init, worker_process_shutdown
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import timezone
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess, start_http_server)
+from prometheus_client.core import GaugeMetricFamily
+
+from . import scheduler
+from .broker import client
+
+logger = logging.getLogger(__name__)
+
+MISSION_DURATION = Histogram("codebox_mission_duration_seconds", "mission execution duration",
+                             ["repository", "playbook", "state"],
+                             buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+PREPARE_DURATION = Histogram("codebox_mission_prepare_seconds", "workdir clone and prepare duration",
+                             buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+EVENTS = Counter("codebox_mission_events_total", "ansible events handled by runner", ["event"])
+EVENT_LATENCY = Histogram("codebox_mission_event_seconds", "event handler duration",
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+CANCEL_POLLS = Counter("codebox_cancel_polls_total", "database polls for mission cancellation")
+WORKDIR_RECLAIMED = Counter("codebox_workdir_reclaimed_bytes_total", "bytes reclaimed from mission workdirs")
+POOL_CLAIMS = Counter("codebox_workdir_pool_claims_total", "warm workdir pool claims", ["result"])
+WORKDIR_SWEEP_DURATION = Histogram("codebox_workdir_sweep_seconds", "workdir sweep duration")
+API_LATENCY = Histogram("codebox_api_request_seconds", "api request duration",
+                        ["view", "action", "method", "status"],
+                        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+
+# 队列相关指标在采集时从数据库和broker读取, 不依赖进程内状态
+class QueueCollector:
+    def describe(self):
+        return []
+
+    def collect(self):
+        queued = scheduler.queued_missions()
+        depth = GaugeMetricFamily("codebox_pending_missions", "missions waiting for dispatch")
+        depth.add_metric([], queued.count())
+        yield depth
+
+        oldest = queued.order_by("created_at").values_list("created_at", flat=True).first()
+        age = GaugeMetricFamily("codebox_pending_mission_age_seconds", "age of the oldest pending mission")
+        age.add_metric([], (timezone.now() - oldest).total_seconds() if oldest else 0)
+        yield age
+
+        try:
+            length = client().llen("celery")
+        except redis.RedisError as e:
+            logger.warning("read celery queue length failed: %s", e)
+        else:
+            celery = GaugeMetricFamily("codebox_celery_queue_length", "messages in celery queue", labels=["queue"])
+            celery.add_metric(["celery"], length)
+            yield celery
+
+
+QUEUE_COLLECTOR = QueueCollector()
+REGISTRY.register(QUEUE_COLLECTOR)
+
+
+def export(request):
+    # 设置PROMETHEUS_MULTIPROC_DIR时, api和worker各进程的指标写入共享目录, 采集时合并
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(QueueCollector())
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+@worker_init.connect
+def start_worker_exporter(sender=None, **kwargs):
+    # worker的任务指标在worker主机上单独导出; prefork的子进程需设置本机的PROMETHEUS_MULTIPROC_DIR, 由主进程合并
+    port = settings.IAC_WORKER_METRICS_PORT
+    if not port:
+        return
+    # 队列指标由api导出
+    REGISTRY.unregister(QUEUE_COLLECTOR)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        if "prefork" in str(getattr(sender, "pool_cls", "prefork")):
+            logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, metrics of prefork pool processes are not exported")
+        registry = REGISTRY
+    try:
+        start_http_server(port, registry=registry)
+    except OSError as e:
+        logger.warning("start worker metrics exporter on port %s failed: %s", port, e)
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None, **kwargs):
+    # 在主进程中清理已退出子进程的gauge文件
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view = getattr(match.func, "cls", None) if match else None
+        if view is not None:
+            actions = getattr(match.func, "actions", None) or {}
+            API_LATENCY.labels(view.__name__, actions.get(request.method.lower(), ""), request.method,
+                               response.status_code).observe(time.perf_counter() - started)
+        return response
@@ -0,0 +1,107 @@
+import fcntl
+import logging
+import os
+import pathlib
+import shutil
+from contextlib import contextmanager
+
+from django.conf import settings
+from git import Git, GitCommandError, InvalidGitRepositoryError, Repo
+
+from .models import Repository
+
+logger = logging.getLogger(__name__)
+
+
+def _size(path: pathlib.Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+# worker本地的仓库裸镜像缓存, 每个任务从镜像本地克隆(硬链接对象)而不是从远端全量克隆
+class RepositoryMirror:
+    def __init__(self, repository: Repository):
+        self.repository = repository
+        self.root = pathlib.Path(settings.IAC_MIRROR_DIR)
+        self.path = self.root.joinpath(f"{repository.id}.git")
+        self.lock_path = self.root.joinpath(f"{repository.id}.lock")
+
+    @contextmanager
+    def lock(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update(self) -> Repo:
+        # 调用方需持有排他锁
+        if self.path.exists():
+            repo = Repo(self.path)
+            if repo.remotes.origin.url != self.repository.url:
+                repo.remotes.origin.set_url(self.repository.url)
+            repo.git.fetch("origin", "--prune")
+        else:
+            repo = Repo.clone_from(url=self.repository.url, to_path=self.path, mirror=True)
+        os.utime(self.lock_path)
+        return repo
+
+    def checkout(self, to_path: pathlib.Path, commit: str = None) -> Repo:
+        with self.lock():
+            self.update()
+            repo = Repo.clone_from(url=str(self.path), to_path=to_path)
+        repo.remotes.origin.set_url(self.repository.url)
+        if commit:
+            repo.git.checkout(commit)
+        return repo
+
+
+def remote_head(repository: Repository) -> str | None:
+    # 只查询远端HEAD, 不拉取对象
+    output = Git().ls_remote(repository.url, "HEAD")
+    return output.split()[0] if output else None
+
+
+def mirror_size(path: pathlib.Path) -> int:
+    # git count-objects只读取对象目录的统计, 不遍历整个镜像
+    try:
+        stats = dict(line.split(": ", 1) for line in Repo(path).git.count_objects("-v").splitlines())
+        return sum(int(stats.get(key, 0)) for key in ("size", "size-pack", "size-garbage")) * 1024
+    except (GitCommandError, InvalidGitRepositoryError, OSError, ValueError):
+        return _size(path)
+
+
+# 由evict_mirrors广播任务在每个worker上调用, 不在任务检出时执行
+def evict():
+    root = pathlib.Path(settings.IAC_MIRROR_DIR)
+    if not root.exists():
+        return
+    mirrors = []
+    for path in root.glob("*.git"):
+        lock_path = path.with_suffix(".lock")
+        used_at = lock_path.stat().st_mtime if lock_path.exists() else 0
+        mirrors.append((used_at, path, lock_path, mirror_size(path)))
+    total = sum(m[3] for m in mirrors)
+    # 按最近使用时间淘汰, 正在使用的镜像跳过
+    for _, path, lock_path, size in sorted(mirrors, key=lambda m: m[0]):
+        if total <= settings.IAC_MIRROR_MAX_SIZE:
+            break
+        with open(lock_path, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logger.info("evict repository mirror %s (%d bytes)", path, size)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,3 +1,5 @@
+import hashlib
+
 from django.contrib.auth.models import User
 from django.db import models
 from django_celery_beat.models import PeriodicTask
@@ -19,10 +21,33 @@ class AuditMixin(TimestampMinIn):
         abstract = True
 
 
+# 执行调优参数, 为空的项使用ansible默认值
+class ExecutionProfile(AuditMixin, models.Model):
+    STRATEGIES = [("linear", "linear"), ("free", "free"), ("host_pinned", "host_pinned")]
+    GATHERINGS = [("implicit", "implicit"), ("explicit", "explicit"), ("smart", "smart")]
+
+    name = models.CharField(max_length=32, unique=True)
+    remark = models.CharField(max_length=512, null=True)
+    forks = models.PositiveSmallIntegerField(null=True)
+    strategy = models.CharField(max_length=16, choices=STRATEGIES, null=True)
+    pipelining = models.BooleanField(null=True)
+    # ssh ControlPersist秒数, 0表示关闭连接复用
+    control_persist = models.PositiveIntegerField(null=True)
+    gathering = models.CharField(max_length=16, choices=GATHERINGS, null=True)
+    # 整个任务的超时秒数
+    timeout = models.PositiveIntegerField(null=True)
+    # 按仓库共享的facts缓存, 后端见IAC_FACT_CACHE_BACKEND, 过期秒数为空时使用IAC_FACT_CACHE_TIMEOUT
+    fact_cache = models.BooleanField(default=False)
+    fact_cache_timeout = models.PositiveIntegerField(null=True)
+
+
 class Repository(AuditMixin, models.Model):
     name = models.CharField(max_length=32, unique=True)
     remark = models.CharField(max_length=512, null=True)
     url = models.CharField(max_length=512, null=True)
+    # 任务事件和输出的保留天数, 为空使用IAC_RETENTION_DAYS, 0表示不归档
+    retention_days = models.PositiveIntegerField(null=True)
+    profile = models.ForeignKey(ExecutionProfile, on_delete=models.PROTECT, null=True, related_name="+")
 
 
 class MissionState(models.IntegerChoices):
@@ -33,17 +58,39 @@ class MissionState(models.IntegerChoices):
     CANCELED = 4, 'CANCELED'
     TIMEOUT = 5, 'TIMEOUT'
     CANCELING = 6, 'CANCELING'
+    # 仓库和清单未变化, 未实际执行
+    SKIPPED = 7, 'SKIPPED'
+
+
+ACTIVE_STATES = [MissionState.PENDING, MissionState.RUNNING, MissionState.CANCELING]
+FINISHED_STATES = [MissionState.COMPLETED, MissionState.FAILED, MissionState.CANCELED, MissionState.TIMEOUT,
+                   MissionState.SKIPPED]
+
+
+def inventory_hash(inventories: str) -> str:
+    return hashlib.sha256((inventories or "").encode()).hexdigest()
 
 
 class MissionMode(models.IntegerChoices):
     MANUAL = 0, 'MANUAL'
     PERIODIC = 1, 'PERIODIC'
+    SHARD = 2, 'SHARD'
+
+
+# 定时任务触发时上一次执行尚未结束的处理方式
+class OverlapPolicy(models.IntegerChoices):
+    ALLOW = 0, 'ALLOW'
+    SKIP = 1, 'SKIP'
+    QUEUE_ONE = 2, 'QUEUE_ONE'
+    CANCEL_PREVIOUS = 3, 'CANCEL_PREVIOUS'
 
 
 class MissionTemplate(AuditMixin, models.Model):
     repository = models.ForeignKey(Repository, on_delete=models.PROTECT)
     playbook = models.CharField(max_length=64)
     inventories = models.TextField(null=True)
+    # 为空时使用仓库的执行配置
+    profile = models.ForeignKey(ExecutionProfile, on_delete=models.PROTECT, null=True, related_name="+")
 
     class Meta:
         abstract = True
@@ -54,9 +101,31 @@ class Mission(MissionTemplate):
     state = models.IntegerField(choices=MissionState.choices, default=MissionState.PENDING)
     output = models.TextField(null=True)
     commit = models.CharField(max_length=64, null=True)
+    inventory_hash = models.CharField(max_length=64, null=True)
+    parent = models.ForeignKey("self", on_delete=models.CASCADE, null=True, related_name="children")
+    # 大于1时按主机拆分为多个SHARD子任务并行执行
+    shards = models.PositiveSmallIntegerField(default=1)
+    # ansible --limit
+    limit = models.TextField(null=True)
+    priority = models.IntegerField(default=0)
+    # 调度器派发执行的时间, 为空表示仍在排队
+    dispatched_at = models.DateTimeField(null=True)
+    # worker认领执行后定期更新, 为空表示尚未开始执行
+    heartbeat_at = models.DateTimeField(null=True)
+    # 事件和输出已归档到文件的时间
+    archived_at = models.DateTimeField(null=True)
+    schedule = models.ForeignKey("PeriodicMission", on_delete=models.SET_NULL, null=True, related_name="missions")
+    # 批量提交的批次号, 用于批量创建后查询id和批量取消
+    batch = models.UUIDField(null=True, db_index=True)
 
     class Meta:
-        ordering = ["-created_at"]
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            models.Index(fields=["created_at", "id"]),
+            models.Index(fields=["repository", "created_at", "id"]),
+            models.Index(fields=["state", "dispatched_at"]),
+            models.Index(fields=["repository", "playbook", "inventory_hash"]),
+        ]
 
 
 class MissionEvent(models.Model):
@@ -75,10 +144,75 @@ class MissionEvent(models.Model):
     res = models.JSONField(null=True)
     changed = models.BooleanField(default=False)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["mission", "uuid", "host"], name="iac_missionevent_identity"),
+        ]
+
+
+class MissionOutputChunk(models.Model):
+    mission = models.ForeignKey(Mission, on_delete=models.CASCADE, related_name="output_chunks")
+    seq = models.IntegerField()
+    start = models.BigIntegerField()
+    end = models.BigIntegerField()
+    compressed = models.BooleanField(default=False)
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = [["mission", "seq"]]
+
+
+class SummaryCounters(models.Model):
+    ok = models.IntegerField(default=0)
+    changed = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    unreachable = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    rescued = models.IntegerField(default=0)
+    ignored = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+
+class MissionSummary(SummaryCounters):
+    mission = models.OneToOneField(Mission, on_delete=models.CASCADE, primary_key=True, related_name="summary")
+    hosts = models.IntegerField(default=0)
+
+
+class MissionHostSummary(SummaryCounters):
+    mission = models.ForeignKey(Mission, on_delete=models.CASCADE, related_name="host_summaries")
+    host = models.CharField(max_length=128)
+    duration = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = [["mission", "host"]]
+
+
+class MissionTaskSummary(models.Model):
+    mission = models.ForeignKey(Mission, on_delete=models.CASCADE, related_name="task_summaries")
+    uuid = models.UUIDField()
+    play = models.CharField(max_length=128)
+    task = models.CharField(max_length=128)
+    task_action = models.CharField(max_length=128)
+    hosts = models.IntegerField(default=0)
+    total_duration = models.FloatField(default=0)
+    max_duration = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = [["mission", "uuid"]]
+
 
 class PeriodicMission(MissionTemplate):
     uuid = models.UUIDField(unique=True, editable=False)
     scheduler = models.OneToOneField(PeriodicTask, on_delete=models.PROTECT, related_name="periodic_mission")
+    overlap_policy = models.IntegerField(choices=OverlapPolicy.choices, default=OverlapPolicy.ALLOW)
+    # 因上一次执行未结束而跳过/合并的触发次数
+    skipped = models.PositiveIntegerField(default=0)
+    coalesced = models.PositiveIntegerField(default=0)
+    # 仓库HEAD与清单和上一次成功执行相同时不执行, 连续跳过converge_every次后强制执行一次, 0表示不强制
+    skip_unchanged = models.BooleanField(default=False)
+    converge_every = models.PositiveIntegerField(default=0)
 
 
 class Authorization(TimestampMinIn, models.Model):
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+from . import archive
+from .models import Mission, MissionOutputChunk, MissionState
+
+logger = logging.getLogger(__name__)
+
+
+# 任务输出按固定大小分块流式写入, 未写满的最后一块按时间间隔覆盖更新
+class OutputWriter:
+    def __init__(self, mission: Mission):
+        self.mission = mission
+        self.chunk_size = settings.IAC_OUTPUT_CHUNK_SIZE
+        self.compress = settings.IAC_OUTPUT_COMPRESS
+        self.flush_interval = settings.IAC_EVENT_FLUSH_INTERVAL
+        self.chunk = MissionOutputChunk(mission=mission, seq=0, start=0, end=0)
+        self.buffer = bytearray()
+        self.dirty = False
+        self.flushed_at = time.monotonic()
+        self.lock = threading.RLock()
+
+    def write(self, text: str):
+        if not text:
+            return
+        data = text.encode()
+        with self.lock:
+            while data:
+                room = self.chunk_size - len(self.buffer)
+                self.buffer += data[:room]
+                data = data[room:]
+                self.dirty = True
+                if len(self.buffer) >= self.chunk_size:
+                    self.flush()
+                    self.chunk = MissionOutputChunk(mission=self.mission, seq=self.chunk.seq + 1,
+                                                    start=self.chunk.end, end=self.chunk.end)
+                    self.buffer = bytearray()
+            if time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.flushed_at = time.monotonic()
+            if not self.dirty:
+                return
+            data = bytes(self.buffer)
+            self.chunk.end = self.chunk.start + len(data)
+            self.chunk.compressed = self.compress
+            self.chunk.data = zlib.compress(data) if self.compress else data
+            self.chunk.save()
+            self.dirty = False
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("flush output of mission %s failed", self.mission.id)
+
+
+def read(mission: Mission, offset: int = None, tail: int = None, limit: int = None) -> dict:
+    limit = min(limit or settings.IAC_OUTPUT_READ_LIMIT, settings.IAC_OUTPUT_READ_LIMIT)
+    legacy = None
+    if mission.archived_at:
+        size = archive.read_meta(mission)["output_size"]
+    else:
+        last = MissionOutputChunk.objects.filter(mission=mission).only("end").order_by("-seq").first()
+        if last is None and mission.output:
+            # 分块存储之前的任务输出在Mission.output中
+            legacy = mission.output.encode()
+            size = len(legacy)
+        else:
+            size = last.end if last else 0
+
+    if tail is not None:
+        offset = max(size - tail, 0)
+    offset = min(max(offset or 0, 0), size)
+    # 多读一个utf-8字符的最大续字节数, 用于把截断位置对齐到字符边界
+    end = min(offset + limit + 3, size)
+
+    if mission.archived_at:
+        data = archive.read_output(mission, offset, end)
+    elif legacy is not None:
+        data = legacy[offset:end]
+    else:
+        data = bytearray()
+        chunks = MissionOutputChunk.objects.filter(mission=mission, end__gt=offset, start__lt=end).order_by("seq")
+        for chunk in chunks:
+            content = zlib.decompress(chunk.data) if chunk.compressed else bytes(chunk.data)
+            data += content[max(offset - chunk.start, 0):end - chunk.start]
+    start, stop = align(data, limit)
+    offset += start
+    data = data[start:stop]
+    return {
+        "offset": offset,
+        "next_offset": offset + len(data),
+        "size": size,
+        "complete": mission.state not in (MissionState.PENDING, MissionState.RUNNING, MissionState.CANCELING),
+        "data": bytes(data).decode(errors="replace"),
+    }
+
+
+def continuation(byte: int) -> bool:
+    return byte & 0xC0 == 0x80
+
+
+def align(data: bytes, limit: int) -> tuple[int, int]:
+    # 跳过开头不完整字符的续字节, 结尾退回到字符起始位置; 不足一个字符时读完该字符
+    start = 0
+    while start < min(3, len(data)) and continuation(data[start]):
+        start += 1
+    stop = min(start + limit, len(data))
+    if stop < len(data):
+        while stop > start and continuation(data[stop]):
+            stop -= 1
+        if stop == start:
+            stop += 1
+            while stop < len(data) and continuation(data[stop]):
+                stop += 1
+    return start, stop
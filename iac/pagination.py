@@ -1,6 +1,13 @@
+import base64
+import hashlib
 from collections import OrderedDict
+from datetime import datetime
 
-from rest_framework.pagination import PageNumberPagination
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 from rest_framework.response import Response
 
 
@@ -46,3 +53,93 @@ class StandardResultSetPagination(PageNumberPagination):
                 'results': schema,
             },
         }
+
+
+# ?cursor=开启按(created_at, id)降序的keyset分页, 不执行偏移查询, count走缓存
+class KeysetResultSetPagination(StandardResultSetPagination):
+    cursor_query_param = "cursor"
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            self.keyset = False
+            return super().paginate_queryset(queryset, request, view)
+        self.keyset = True
+        self.request = request
+        self.size = self.get_page_size(request)
+        self.count = None
+        if request.query_params.get(self.count_query_param, "").lower() not in ("0", "false"):
+            self.count = self.get_cached_count(queryset)
+
+        queryset = queryset.order_by("-created_at", "-id")
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            created_at, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+        results = list(queryset[:self.size + 1])
+        self.next_cursor = self.encode_cursor(results[self.size - 1]) if len(results) > self.size else None
+        return results[:self.size]
+
+    def get_cached_count(self, queryset):
+        key = "iac:pagination:count:" + hashlib.md5(str(queryset.query).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, settings.IAC_PAGINATION_COUNT_CACHE_TTL)
+        return count
+
+    def encode_cursor(self, instance):
+        value = f"{instance.created_at.isoformat()}|{instance.id}"
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return datetime.fromisoformat(created_at), int(pk)
+        except ValueError:
+            raise NotFound("invalid cursor")
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('page', None),
+            ('size', self.size),
+            ('num_pages', None),
+            ('next', self.next_cursor),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema['properties']['next'] = {
+            'type': 'string',
+            'description': 'cursor of next page, only present with ?cursor=',
+            'nullable': True
+        }
+        return schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'keyset pagination cursor, pass empty value for first page',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.count_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'set false to skip count in keyset pagination',
+                'schema': {'type': 'boolean'},
+            },
+        ]
+
+
+class MissionEventCursorPagination(CursorPagination):
+    ordering = "id"
+    page_size_query_param = "size"
+    max_page_size = 1000
@@ -0,0 +1,128 @@
+import fcntl
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+from git import GitCommandError, Repo
+
+from . import metrics, workdir
+from .mirror import RepositoryMirror, remote_head
+from .models import Mission, Repository
+
+logger = logging.getLogger(__name__)
+
+
+def repository_dir(repository_id) -> pathlib.Path:
+    return workdir.pool_root().joinpath(str(repository_id))
+
+
+def entries(repository_id, commit: str = None) -> list[pathlib.Path]:
+    path = repository_dir(repository_id)
+    if not path.is_dir():
+        return []
+    return [entry for entry in path.iterdir()
+            if not entry.name.startswith(".") and (commit is None or entry.name.startswith(commit + "-"))]
+
+
+# 领取预热好的工作目录, 通过rename原子地移动到任务目录, 多个进程竞争同一目录时只有一个成功;
+# 领取时不补充, 由调用方在任务检出完成后调用refill_async, 避免补充的克隆与任务自己的检出竞争镜像锁
+def claim(repository: Repository, mission_id, commit: str = None) -> Repo | None:
+    if settings.IAC_WORKDIR_POOL_SIZE <= 0:
+        return None
+    # 本机没有预热目录时直接返回, 不查询远端
+    if not entries(repository.id):
+        metrics.POOL_CLAIMS.labels("miss").inc()
+        return None
+    if commit is None:
+        try:
+            commit = remote_head(repository)
+        except GitCommandError as e:
+            logger.warning("ls-remote of repository %s failed: %s", repository.id, e)
+            return None
+    target = workdir.clear(mission_id)
+    for entry in entries(repository.id, commit):
+        try:
+            os.rename(entry, target)
+        except OSError:
+            continue
+        os.utime(target)
+        metrics.POOL_CLAIMS.labels("hit").inc()
+        return Repo(target)
+    metrics.POOL_CLAIMS.labels("miss").inc()
+    return None
+
+
+# fetch为False时直接使用镜像当前的HEAD, 用于任务刚检出过(已拉取)的仓库
+def refill(repository: Repository, fetch: bool = True):
+    if settings.IAC_WORKDIR_POOL_SIZE <= 0 or workdir.under_pressure():
+        return
+    path = repository_dir(repository.id)
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        try:
+            # 持有锁时残留的临时目录来自异常退出的补充过程
+            for entry in path.glob(".*"):
+                shutil.rmtree(entry, ignore_errors=True)
+            mirror = RepositoryMirror(repository)
+            with mirror.lock():
+                repo = mirror.update() if fetch or not mirror.path.exists() else Repo(mirror.path)
+                head = repo.head.commit.hexsha
+            # 远端已更新的旧目录不再可用, 先改名再删除, 避免删除正在被领取的目录
+            for entry in entries(repository.id):
+                if not entry.name.startswith(head + "-"):
+                    stale = path.joinpath(f".{entry.name}")
+                    try:
+                        os.rename(entry, stale)
+                    except OSError:
+                        continue
+                    shutil.rmtree(stale, ignore_errors=True)
+            for _ in range(settings.IAC_WORKDIR_POOL_SIZE - len(entries(repository.id, head))):
+                tmp = path.joinpath(f".{uuid.uuid4().hex}")
+                with mirror.lock():
+                    repo = Repo.clone_from(url=str(mirror.path), to_path=tmp)
+                repo.remotes.origin.set_url(repository.url)
+                os.rename(tmp, path.joinpath(f"{repo.head.commit.hexsha}-{uuid.uuid4().hex}"))
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def refill_async(repository: Repository, fetch: bool = True):
+    def target():
+        try:
+            refill(repository, fetch)
+        except Exception:
+            logger.exception("refill workdir pool of repository %s failed", repository.id)
+
+    threading.Thread(target=target, daemon=True).start()
+
+
+def refresh():
+    # 为最近使用的仓库补充预热目录, 清理其余仓库的预热目录
+    if settings.IAC_WORKDIR_POOL_SIZE <= 0:
+        if workdir.pool_root().exists():
+            workdir.remove(workdir.pool_root())
+        return
+    since = timezone.now() - timedelta(hours=settings.IAC_WORKDIR_POOL_RECENT_HOURS)
+    recent = Mission.objects.filter(created_at__gte=since).values("repository") \
+        .annotate(last=Max("created_at")).order_by("-last")[:settings.IAC_WORKDIR_POOL_REPOSITORIES]
+    repositories = Repository.objects.in_bulk([row["repository"] for row in recent])
+    if workdir.pool_root().exists():
+        for path in workdir.pool_root().iterdir():
+            if path.is_dir() and path.name.isdigit() and int(path.name) not in repositories:
+                workdir.remove(path)
+    for repository in repositories.values():
+        try:
+            refill(repository)
+        except Exception:
+            logger.exception("refill workdir pool of repository %s failed", repository.id)
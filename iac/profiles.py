@@ -0,0 +1,42 @@
+from .facts import FactCache
+from .models import ExecutionProfile, Mission
+
+
+def resolve(mission: Mission) -> ExecutionProfile | None:
+    return mission.profile or mission.repository.profile
+
+
+def fact_cache(mission: Mission) -> FactCache | None:
+    profile = resolve(mission)
+    if profile is None or not profile.fact_cache:
+        return None
+    return FactCache(mission.repository, profile.fact_cache_timeout)
+
+
+# 执行配置转换为ansible_runner.run的参数, 调优项通过环境变量传给ansible
+def run_options(mission: Mission) -> dict:
+    profile = resolve(mission)
+    if profile is None:
+        return {}
+    envvars = {}
+    if profile.strategy:
+        envvars["ANSIBLE_STRATEGY"] = profile.strategy
+    if profile.pipelining is not None:
+        envvars["ANSIBLE_PIPELINING"] = str(profile.pipelining)
+    if profile.control_persist is not None:
+        envvars["ANSIBLE_SSH_ARGS"] = f"-C -o ControlMaster=auto -o ControlPersist={profile.control_persist}s" \
+            if profile.control_persist else "-C -o ControlMaster=no"
+    if profile.gathering:
+        envvars["ANSIBLE_GATHERING"] = profile.gathering
+    options = {}
+    if profile.fact_cache:
+        # 缓存未过期的主机不再收集facts
+        envvars["ANSIBLE_GATHERING"] = profile.gathering or "smart"
+        options = FactCache(mission.repository, profile.fact_cache_timeout).run_options()
+        envvars.update(options["envvars"])
+    options["envvars"] = envvars
+    if profile.forks:
+        options["forks"] = profile.forks
+    if profile.timeout:
+        options["timeout"] = profile.timeout
+    return options
@@ -1,21 +1,43 @@
-import pathlib
+import contextlib
+import logging
 import threading
-from datetime import datetime
+import time
 
-from ansible_runner.interface import run
+from ansible_runner.interface import run, get_inventory
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
 from django.utils import timezone
-from git import Repo
 
-from .models import Mission, MissionState, MissionEvent
+from . import archive, cancellation, metrics, pool, profiles, streaming, workdir
+from .events import EventWriter
+from .ingestion import ArtifactIngester
+from .mirror import RepositoryMirror
+from .output import OutputWriter
+from .summary import SummaryCollector, update_mission_summary
+from .models import Mission, MissionState, MissionMode, MissionEvent, MissionHostSummary, ACTIVE_STATES, \
+    inventory_hash
+
+logger = logging.getLogger(__name__)
 
 
 class Runner:
     def __init__(self, model: Mission):
         self.model = model
-        self.workdir = pathlib.Path(settings.IAC_WORKDIR, str(self.model.id))
+        self.workdir = workdir.path(self.model.id)
+        # 分片子任务的事件和汇总写入父任务
+        event_mission = model.parent if model.mode == MissionMode.SHARD else model
+        self.event_mission = event_mission
+        self.events = EventWriter(event_mission, self.workdir)
+        self.summary = SummaryCollector(event_mission)
+        self.output = OutputWriter(model)
+        # 延迟入库模式下事件回调只更新状态和汇总, 完整事件由ansible-runner写入job_events后批量导入
+        self.ingester = ArtifactIngester(event_mission, self.workdir) \
+            if settings.IAC_EVENT_INGESTION == "deferred" else None
+        self.cancel_signal = cancellation.CancelSignal(model.id, self.check_canceled)
 
-    def on_event(self, event: MissionEvent):
+    def on_event(self, event: dict):
         # {
         #     "uuid": "fc3ac25c-a160-4cbf-84d8-c1d4219523ce",
         #     "counter": 10,
@@ -43,38 +65,22 @@ class Runner:
         #         "uuid": "fc3ac25c-a160-4cbf-84d8-c1d4219523ce"
         #     }
         # }
-        if event["event"].startswith("runner_on"):
-            uuid = event["parent_uuid"]
-            data = event["event_data"]
-            host = data['host']
-            try:
-                model = MissionEvent.objects.filter(uuid=uuid, host=host).get()
-            except MissionEvent.DoesNotExist:
-                model = MissionEvent()
-            model.uuid = uuid
-            model.mission = self.model
-            model.state = event["event"].removeprefix("runner_on_")
-            model.play = data["play"]
-            model.play_pattern = data["play_pattern"]
-            model.task = data["task"]
-            model.task_action = data["task_action"]
-            model.task_args = data["task_args"]
-            model.host = host
-            model.res = data.get("res", {})
-            dt = data.get("start")
-            if dt:
-                model.start = timezone.make_aware(datetime.fromisoformat(dt))
-            dt = data.get("end")
-            if dt:
-                model.end = timezone.make_aware(datetime.fromisoformat(dt))
-            model.duration = data.get("duration")
-            model.changed = data.get("res", {}).get("changed", False)
-            model.save()
+        started = time.perf_counter()
+        if event.get("stdout"):
+            self.output.write(event["stdout"] + "\n")
+        self.summary.add(event)
+        if event["event"].startswith("runner_on") and self.ingester is None:
+            self.events.write(event)
+        metrics.EVENTS.labels(event["event"]).inc()
+        metrics.EVENT_LATENCY.observe(time.perf_counter() - started)
+        # 返回True时ansible-runner才写出job_events文件
+        return self.ingester is not None
 
     def on_status(self, status: dict, runner_config):
         match status['status']:
             case "starting" | "running":
-                self.model.state = MissionState.RUNNING
+                # 开始执行前已被取消的任务保持CANCELING, 由取消回调终止
+                self.model.state = MissionState.CANCELING if self.check_canceled() else MissionState.RUNNING
             case "canceled":
                 self.model.state = MissionState.CANCELED
             case "timeout":
@@ -84,39 +90,250 @@ class Runner:
             case "successful":
                 self.model.state = MissionState.COMPLETED
         self.model.save()
+        streaming.publish_state(self.model)
 
+    @metrics.PREPARE_DURATION.time()
     def prepare(self):
-        self.workdir.mkdir(parents=True)
-        repo = Repo.clone_from(url=self.model.repository.url, to_path=self.workdir)
+        # 优先使用预热好的工作目录, 只需写入清单
+        repo = pool.claim(self.model.repository, self.model.id, self.model.commit)
+        claimed = repo is not None
+        if repo is None:
+            workdir.create(self.model.id)
+            repo = RepositoryMirror(self.model.repository).checkout(self.workdir, commit=self.model.commit)
+        # 检出完成后再补充预热目录; 刚从镜像检出时镜像已是最新, 不再拉取
+        pool.refill_async(self.model.repository, fetch=claimed)
         if self.model.inventories:
             with open(self.workdir.joinpath("inventory/hosts"), 'w') as writer:
                 writer.write(self.model.inventories)
         self.model.commit = repo.head.commit.hexsha
+        self.model.inventory_hash = inventory_hash(self.model.inventories)
 
     @classmethod
     def cancel(cls, mission: Mission):
+        # 条件更新, 避免过期的实例覆盖调度器或worker写入的状态
+        if mission.state == MissionState.PENDING and mission.dispatched_at is None \
+                and mission.mode != MissionMode.SHARD:
+            # 仍在调度队列中的任务直接取消, 已被派发时按运行中任务处理
+            if Mission.objects.filter(id=mission.id, state=MissionState.PENDING, dispatched_at__isnull=True) \
+                    .update(state=MissionState.CANCELED, updated_at=timezone.now()):
+                mission.state = MissionState.CANCELED
+            else:
+                mission.refresh_from_db(fields=["state", "dispatched_at"])
         if mission.state == MissionState.RUNNING or mission.state == MissionState.PENDING:
-            mission.state = MissionState.CANCELING
-            mission.save()
+            if Mission.objects.filter(id=mission.id, state__in=[MissionState.RUNNING, MissionState.PENDING]) \
+                    .update(state=MissionState.CANCELING, updated_at=timezone.now()):
+                mission.state = MissionState.CANCELING
+                cancellation.publish(mission.id)
+        for child in mission.children.filter(mode=MissionMode.SHARD,
+                                             state__in=[MissionState.RUNNING, MissionState.PENDING]):
+            cls.cancel(child)
+
+    @classmethod
+    def cancel_many(cls, missions) -> int:
+        # 排队中的任务一条语句取消, 已派发的逐个通知
+        count = missions.filter(state=MissionState.PENDING, dispatched_at__isnull=True) \
+            .exclude(mode=MissionMode.SHARD).update(state=MissionState.CANCELED, updated_at=timezone.now())
+        for mission in missions.filter(state__in=[MissionState.RUNNING, MissionState.PENDING]):
+            cls.cancel(mission)
+            count += 1
+        return count
+
+    @contextlib.contextmanager
+    def heartbeat(self):
+        # 执行期间定期更新心跳, 调度器据此回收worker异常退出的任务
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(settings.IAC_HEARTBEAT_INTERVAL):
+                try:
+                    # 同时更新实例, 避免保存状态时写回旧的心跳时间
+                    self.model.heartbeat_at = timezone.now()
+                    Mission.objects.filter(id=self.model.id).update(heartbeat_at=self.model.heartbeat_at)
+                except Exception:
+                    logger.exception("heartbeat of mission %s failed", self.model.id)
+            connection.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def check_canceled(self):
+        return Mission.objects.filter(id=self.model.id, state=MissionState.CANCELING).exists()
 
     def is_canceled(self):
-        return Mission.objects.get(id=self.model.id).state == MissionState.CANCELING
+        return self.cancel_signal.is_set()
 
     def exec(self):
+        started = time.monotonic()
+        ingested = True
+        self.cancel_signal.start()
         try:
             self.prepare()
-            runner = run(private_data_dir=self.workdir,
-                         playbook=self.model.playbook,
-                         event_handler=self.on_event,
-                         status_handler=self.on_status,
-                         cancel_callback=self.is_canceled
-                         )
-            self.model.output = runner.stdout.read()
-        except Exception as e:
-            print(e)
+            if self.ingester is not None:
+                # 先标记再执行, worker异常退出时保留job_events待重新导入
+                workdir.mark_pending(self.model.id)
+                self.ingester.start()
+            run(private_data_dir=self.workdir,
+                playbook=self.model.playbook,
+                event_handler=self.on_event,
+                status_handler=self.on_status,
+                cancel_callback=self.is_canceled,
+                limit=self.model.limit,
+                **profiles.run_options(self.model)
+                )
+        except Exception:
+            logger.exception("exec mission %s failed", self.model.id)
             self.model.state = MissionState.FAILED
         finally:
+            self.cancel_signal.stop()
+            # 失败或取消时也要把缓冲的事件和输出写完
+            if self.ingester is not None:
+                ingested = self.ingester.stop()
+            if not self.events.close():
+                ingested = False
+            self.summary.close()
+            self.output.close()
             self.model.save()
+            streaming.publish_state(self.model)
+            self.invalidate_facts()
+            metrics.MISSION_DURATION.labels(self.model.repository.name, self.model.playbook,
+                                            MissionState(self.model.state).name.lower()) \
+                .observe(time.monotonic() - started)
+            # 导入完成后清理会删除标记; 导入失败时保留job_events和转存的事件, 由ingestion.recover重新导入
+            if ingested:
+                self.cleanup()
+            else:
+                self.keep_events()
+
+    def invalidate_facts(self):
+        # 失败和不可达主机的facts可能已过时, 下次执行时重新收集
+        try:
+            cache = profiles.fact_cache(self.model)
+            if cache is None:
+                return
+            hosts = self.failed_hosts(self.event_mission)
+            if self.model.limit:
+                hosts = [host for host in hosts if host in set(self.model.limit.split(","))]
+            cache.delete(*hosts)
+        except Exception:
+            logger.exception("invalidate facts of mission %s failed", self.model.id)
+
+    def cleanup(self):
+        try:
+            workdir.cleanup(self.model.id)
+        except OSError:
+            logger.exception("cleanup workdir of mission %s failed", self.model.id)
+
+    def keep_events(self):
+        try:
+            workdir.mark_pending(self.model.id)
+        except OSError:
+            logger.exception("mark pending ingestion of mission %s failed", self.model.id)
+
+    def list_hosts(self) -> list[str]:
+        inventory, error = get_inventory(action="list", inventories=[str(self.workdir.joinpath("inventory"))],
+                                         response_format="json", quiet=True)
+        if not isinstance(inventory, dict):
+            raise RuntimeError(f"list inventory failed: {error}")
+        hosts = set(inventory.get("_meta", {}).get("hostvars", {}))
+        for name, group in inventory.items():
+            if name != "_meta":
+                hosts.update(group.get("hosts", []))
+        if self.model.limit:
+            # 重试等场景的limit为主机列表
+            hosts &= set(self.model.limit.split(","))
+        return sorted(hosts)
+
+    def shard(self) -> list[Mission]:
+        # 按主机拆分为分片子任务, 由调用方派发
+        try:
+            self.prepare()
+            hosts = self.list_hosts()
+            if not hosts:
+                raise RuntimeError("no hosts in inventory")
+            count = min(self.model.shards, len(hosts))
+            # 主机数少于分片数时按实际分片数占用执行槽位
+            self.model.shards = count
+            self.model.state = MissionState.CANCELING if self.check_canceled() else MissionState.RUNNING
+            self.model.save()
+            streaming.publish_state(self.model)
+            children = []
+            for i in range(count):
+                children.append(Mission.objects.create(
+                    parent=self.model,
+                    mode=MissionMode.SHARD,
+                    repository=self.model.repository,
+                    playbook=self.model.playbook,
+                    inventories=self.model.inventories,
+                    commit=self.model.commit,
+                    limit=",".join(hosts[i::count]),
+                    profile=self.model.profile,
+                    created_by=self.model.created_by
+                ))
+            if self.check_canceled():
+                self.cancel(self.model)
+            return children
+        except Exception:
+            logger.exception("shard mission %s failed", self.model.id)
+            self.model.state = MissionState.FAILED
+            self.model.save()
+            return []
+        finally:
+            # 子任务各自检出, 父任务目录只用于列出主机
+            self.cleanup()
+
+    @classmethod
+    def collect(cls, mission: Mission):
+        # 分片全部返回后仍未结束的子任务是执行前异常退出的, 不会再更新状态
+        mission.children.filter(mode=MissionMode.SHARD, state__in=ACTIVE_STATES) \
+            .update(state=MissionState.FAILED, updated_at=timezone.now())
+        states = set(mission.children.filter(mode=MissionMode.SHARD).values_list("state", flat=True))
+        for state in (MissionState.CANCELED, MissionState.FAILED, MissionState.TIMEOUT):
+            if state in states:
+                mission.state = state
+                break
+        else:
+            mission.state = MissionState.COMPLETED
+        mission.save()
+        update_mission_summary(mission)
+        streaming.publish_state(mission)
+
+    @classmethod
+    def failed_hosts(cls, mission: Mission) -> list[str]:
+        # 以汇总为准(已排除ignore_errors和rescue), 没有汇总的旧任务从事件中查找
+        summaries = MissionHostSummary.objects.filter(mission=mission)
+        if summaries.exists():
+            hosts = summaries.filter(Q(failures__gt=0) | Q(unreachable__gt=0)).values_list("host", flat=True)
+        elif mission.archived_at:
+            hosts = [event["host"] for event in archive.read_events(mission)
+                     if event["state"] in ("failed", "unreachable")]
+        else:
+            hosts = MissionEvent.objects.filter(mission=mission, state__in=["failed", "unreachable"]) \
+                .values_list("host", flat=True)
+        return sorted(set(hosts))
+
+    @classmethod
+    def retry(cls, mission: Mission, user: User) -> Mission | None:
+        # 只对失败和不可达的主机在同一commit上重新执行
+        hosts = cls.failed_hosts(mission)
+        if not hosts:
+            return None
+        return Mission.objects.create(
+            parent=mission,
+            repository=mission.repository,
+            playbook=mission.playbook,
+            inventories=mission.inventories,
+            commit=mission.commit,
+            limit=",".join(hosts),
+            shards=min(mission.shards, len(hosts)),
+            priority=mission.priority,
+            profile=mission.profile,
+            created_by=user
+        )
 
     def run(self):
         t = threading.Thread(target=self.exec)
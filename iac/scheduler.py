@@ -0,0 +1,151 @@
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef, Sum
+from django.utils import timezone
+
+from . import streaming
+from .broker import client
+from .models import Mission, MissionState, MissionMode, OverlapPolicy, ACTIVE_STATES
+
+logger = logging.getLogger(__name__)
+
+
+def active_missions():
+    # 已派发且未结束的任务按分片数占用执行槽位, 分片子任务计入其父任务
+    return Mission.objects.filter(state__in=ACTIVE_STATES, dispatched_at__isnull=False) \
+        .exclude(mode=MissionMode.SHARD)
+
+
+def queued_missions():
+    return Mission.objects.filter(state=MissionState.PENDING, dispatched_at__isnull=True) \
+        .exclude(mode=MissionMode.SHARD)
+
+
+def count_by_repository(queryset) -> dict[int, int]:
+    rows = queryset.values("repository").annotate(count=Count("id")).order_by()
+    return {row["repository"]: row["count"] for row in rows}
+
+
+def slots_by_repository(queryset) -> dict[int, int]:
+    rows = queryset.values("repository").annotate(slots=Sum("shards")).order_by()
+    return {row["repository"]: row["slots"] for row in rows}
+
+
+def select(queued: list[Mission], running: dict[int, int]) -> list[Mission]:
+    # 各仓库队首按优先级和创建时间排序, 每轮每个仓库最多取一个, 直到达到并发上限;
+    # running为各仓库已占用的槽位数, 每个任务占用分片数个槽位
+    total = sum(running.values())
+    queues = defaultdict(list)
+    for mission in queued:
+        queues[mission.repository_id].append(mission)
+    selected = []
+    while queues:
+        heads = sorted(queues.items(), key=lambda item: (-item[1][0].priority, item[1][0].created_at, item[1][0].id))
+        for repository, queue in heads:
+            slots = queue[0].shards
+            # 全局槽位不足时停止派发, 避免后面的小任务一直占满槽位使大任务饿死
+            if total + slots > settings.IAC_MAX_CONCURRENT_MISSIONS:
+                return selected
+            if running.get(repository, 0) + slots > settings.IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY:
+                del queues[repository]
+                continue
+            selected.append(queue.pop(0))
+            running[repository] = running.get(repository, 0) + slots
+            total += slots
+            if not queue:
+                del queues[repository]
+    return selected
+
+
+def claim(mission: Mission) -> bool:
+    # worker开始执行前认领任务, 重复投递或已被重新排队的消息认领失败
+    missions = Mission.objects.filter(id=mission.id, state=MissionState.PENDING, heartbeat_at__isnull=True)
+    if mission.mode != MissionMode.SHARD:
+        missions = missions.filter(dispatched_at__isnull=False)
+    now = timezone.now()
+    if not missions.update(heartbeat_at=now):
+        return False
+    mission.heartbeat_at = now
+    return True
+
+
+def reap() -> list[Mission]:
+    # 回收消息丢失或worker异常退出后一直占用执行槽位的任务, 返回需要汇总的分片父任务
+    cutoff = timezone.now() - timedelta(seconds=settings.IAC_DISPATCH_TIMEOUT)
+    Mission.objects.filter(state=MissionState.PENDING, heartbeat_at__isnull=True, dispatched_at__lt=cutoff) \
+        .exclude(mode=MissionMode.SHARD).update(dispatched_at=None)
+    lost = Mission.objects.filter(state__in=ACTIVE_STATES, heartbeat_at__lt=cutoff)
+    for mission in lost.filter(mode=MissionMode.SHARD):
+        fail(mission, cutoff)
+    # 分片父任务只在执行分片后停止心跳, 子任务全部结束后汇总
+    active_children = Mission.objects.filter(parent=OuterRef("pk"), mode=MissionMode.SHARD, state__in=ACTIVE_STATES)
+    parents = []
+    for mission in lost.exclude(mode=MissionMode.SHARD).exclude(Exists(active_children)):
+        if mission.children.filter(mode=MissionMode.SHARD).exists():
+            logger.warning("collect lost shards of mission %s", mission.id)
+            parents.append(mission)
+        else:
+            fail(mission, cutoff)
+    return parents
+
+
+def fail(mission: Mission, cutoff):
+    state = MissionState.CANCELED if mission.state == MissionState.CANCELING else MissionState.FAILED
+    if Mission.objects.filter(id=mission.id, state__in=ACTIVE_STATES, heartbeat_at__lt=cutoff) \
+            .update(state=state, updated_at=timezone.now()):
+        logger.warning("mission %s lost heartbeat since %s", mission.id, mission.heartbeat_at)
+        mission.state = state
+        streaming.publish_state(mission)
+
+
+def schedule() -> list[int]:
+    # 返回本次需要派发执行的任务id, 多个调度方通过redis锁互斥
+    try:
+        lock = client().lock("codebox:scheduler", timeout=60, blocking_timeout=10)
+        if not lock.acquire():
+            return []
+    except redis.RedisError as e:
+        logger.warning("acquire scheduler lock failed: %s", e)
+        return []
+    try:
+        queued = list(queued_missions().order_by("-priority", "created_at", "id")
+                      [:settings.IAC_SCHEDULER_SCAN_LIMIT])
+        # QUEUE_ONE定时任务在上一次执行结束前保持排队
+        held = set(active_missions().filter(schedule__overlap_policy=OverlapPolicy.QUEUE_ONE)
+                   .values_list("schedule_id", flat=True))
+        queued = [mission for mission in queued if mission.schedule_id not in held]
+        if not queued:
+            return []
+        selected = [mission.id for mission in select(queued, slots_by_repository(active_missions()))]
+        # 条件更新, 扫描之后被取消的任务不再派发
+        now = timezone.now()
+        Mission.objects.filter(id__in=selected, state=MissionState.PENDING, dispatched_at__isnull=True) \
+            .update(dispatched_at=now)
+        return list(Mission.objects.filter(id__in=selected, dispatched_at=now).values_list("id", flat=True))
+    finally:
+        try:
+            lock.release()
+        except redis.RedisError:
+            pass
+
+
+def stats() -> dict:
+    # running为占用的槽位数, 与并发上限对应
+    running = slots_by_repository(active_missions())
+    pending = count_by_repository(queued_missions())
+    oldest = queued_missions().order_by("created_at").values_list("created_at", flat=True).first()
+    return {
+        "max_concurrent": settings.IAC_MAX_CONCURRENT_MISSIONS,
+        "max_concurrent_per_repository": settings.IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY,
+        "running": sum(running.values()),
+        "pending": sum(pending.values()),
+        "oldest_pending_at": oldest,
+        "repositories": [
+            {"repository": repository, "running": running.get(repository, 0), "pending": pending.get(repository, 0)}
+            for repository in sorted(running.keys() | pending.keys())
+        ],
+    }
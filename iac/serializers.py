@@ -5,12 +5,14 @@ from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.db.models import Count, Q
 from django.utils import timezone
 from django_celery_beat.models import PeriodicTask, IntervalSchedule, CrontabSchedule
 from rest_framework.exceptions import ValidationError
-from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField, CharField
+from rest_framework.serializers import ModelSerializer, PrimaryKeyRelatedField, CharField, Serializer, \
+    IntegerField, BooleanField, SerializerMethodField, DateTimeField, ListField, UUIDField, JSONField
 
-from . import models
+from . import archive, models
 
 
 class LoginSerializer(ModelSerializer):
@@ -60,10 +62,44 @@ class MutationSerializerMixin:
         return fields
 
 
+class SparseFieldsSerializerMixin:
+    # 默认不返回的字段, 可通过?fields=a,b,c显式选择
+    default_excluded_fields = ()
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        selected = request.query_params.get("fields") if request else None
+        if selected:
+            selected = set(selected.split(","))
+            return {name: field for name, field in fields.items() if name in selected}
+        return {name: field for name, field in fields.items() if name not in self.default_excluded_fields}
+
+
+class ExecutionProfileCreationSerializer(ModelSerializer):
+    class Meta:
+        model = models.ExecutionProfile
+        fields = ["name", "remark", "forks", "strategy", "pipelining", "control_persist", "gathering", "timeout",
+                  "fact_cache", "fact_cache_timeout"]
+
+
+class ExecutionProfileSerializer(ModelSerializer):
+    created_by = UserSerializer(read_only=True)
+    updated_by = UserSerializer(read_only=True)
+
+    class Meta:
+        model = models.ExecutionProfile
+        fields = "__all__"
+
+
+class ExecutionProfileMutationSerializer(MutationSerializerMixin, ExecutionProfileCreationSerializer):
+    pass
+
+
 class RepositoryCreationSerializer(ModelSerializer):
     class Meta:
         model = models.Repository
-        fields = ["name", "remark", "url"]
+        fields = ["name", "remark", "url", "retention_days", "profile"]
 
 
 class RepositorySerializer(ModelSerializer):
@@ -78,7 +114,16 @@ class RepositorySerializer(ModelSerializer):
 class RepositoryMutationSerializer(MutationSerializerMixin, ModelSerializer):
     class Meta:
         model = models.Repository
-        fields = ["name", "remark"]
+        fields = ["name", "remark", "retention_days", "profile"]
+
+
+class FactCacheHostSerializer(Serializer):
+    host = CharField()
+    updated_at = DateTimeField()
+
+
+class HostFactsSerializer(FactCacheHostSerializer):
+    facts = JSONField()
 
 
 class MissionCreationSerializer(ModelSerializer):
@@ -86,7 +131,57 @@ class MissionCreationSerializer(ModelSerializer):
 
     class Meta:
         model = models.Mission
-        fields = ["repository", "playbook", "inventories"]
+        fields = ["repository", "playbook", "inventories", "shards", "priority", "profile"]
+
+    def validate_shards(self, value):
+        # 每个分片占用一个执行槽位, 超过并发上限的任务永远无法派发
+        limit = min(settings.IAC_MAX_SHARDS, settings.IAC_MAX_CONCURRENT_MISSIONS,
+                    settings.IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY)
+        if not 1 <= value <= limit:
+            raise ValidationError(f"shards must be between 1 and {limit}")
+        return value
+
+
+class MissionBulkItemSerializer(MissionCreationSerializer):
+    # 仓库和执行配置在MissionBulkCreationSerializer中一次查询校验
+    repository = IntegerField(min_value=1)
+    profile = IntegerField(min_value=1, required=False, allow_null=True)
+
+
+class MissionBulkCreationSerializer(Serializer):
+    missions = MissionBulkItemSerializer(many=True, allow_empty=False)
+
+    def validate_missions(self, value):
+        if len(value) > settings.IAC_BULK_MAX_MISSIONS:
+            raise ValidationError(f"at most {settings.IAC_BULK_MAX_MISSIONS} missions per request")
+        repositories = models.Repository.objects.in_bulk({item["repository"] for item in value})
+        missing = sorted({item["repository"] for item in value} - set(repositories))
+        if missing:
+            raise ValidationError(f"repository {missing} does not exist")
+        ids = {item["profile"] for item in value if item.get("profile")}
+        profiles = models.ExecutionProfile.objects.in_bulk(ids)
+        missing = sorted(ids - set(profiles))
+        if missing:
+            raise ValidationError(f"profile {missing} does not exist")
+        for item in value:
+            item["repository"] = repositories[item["repository"]]
+            item["profile"] = profiles.get(item.get("profile"))
+        return value
+
+
+class MissionBulkSerializer(Serializer):
+    batch = UUIDField()
+    ids = ListField(child=IntegerField())
+
+
+class MissionBulkCancelSerializer(Serializer):
+    batch = UUIDField(required=False)
+    ids = ListField(child=IntegerField(), required=False, allow_empty=False)
+
+    def validate(self, attrs):
+        if not attrs.get("batch") and not attrs.get("ids"):
+            raise ValidationError("batch or ids is required")
+        return attrs
 
 
 class MissionEventSerializer(ModelSerializer):
@@ -95,26 +190,119 @@ class MissionEventSerializer(ModelSerializer):
         fields = '__all__'
 
 
+class MissionEventListSerializer(SparseFieldsSerializerMixin, ModelSerializer):
+    default_excluded_fields = ("res",)
+
+    class Meta:
+        model = models.MissionEvent
+        fields = '__all__'
+
+
+class MissionSummarySerializer(ModelSerializer):
+    class Meta:
+        model = models.MissionSummary
+        exclude = ["mission"]
+
+
+class MissionHostSummarySerializer(ModelSerializer):
+    class Meta:
+        model = models.MissionHostSummary
+        exclude = ["id", "mission"]
+
+
+class MissionTaskSummarySerializer(ModelSerializer):
+    class Meta:
+        model = models.MissionTaskSummary
+        exclude = ["id", "mission", "uuid"]
+
+
+class MissionStatsSerializer(Serializer):
+    hosts = MissionHostSummarySerializer(many=True)
+    tasks = MissionTaskSummarySerializer(many=True)
+
+
+class ShardIdsSerializerMixin:
+    # 分片任务的输出保存在各子任务上, 返回子任务id供按子任务读取输出
+    def get_shard_ids(self, instance) -> list[int]:
+        if instance.shards <= 1 or instance.mode == models.MissionMode.SHARD:
+            return []
+        return list(instance.children.order_by("id").values_list("id", flat=True))
+
+
 class MissionSerializer(ModelSerializer):
     repository = RepositorySerializer(read_only=True)
     created_by = UserSerializer(read_only=True)
     updated_by = UserSerializer(read_only=True)
+    summary = MissionSummarySerializer(read_only=True)
 
     class Meta:
         model = models.Mission
         fields = '__all__'
 
 
-class MissionWithEventsSerializer(ModelSerializer):
+class MissionWithEventCountsSerializer(ShardIdsSerializerMixin, ModelSerializer):
     repository = RepositorySerializer(read_only=True)
     created_by = UserSerializer(read_only=True)
     updated_by = UserSerializer(read_only=True)
+    summary = MissionSummarySerializer(read_only=True)
+    event_counts = SerializerMethodField()
+    shard_ids = SerializerMethodField()
+
+    class Meta:
+        model = models.Mission
+        fields = '__all__'
+
+    def get_event_counts(self, instance) -> dict:
+        if instance.archived_at:
+            return archive.count_events(instance)
+        counts = instance.events.aggregate(total=Count("id"), hosts=Count("host", distinct=True),
+                                           changed=Count("id", filter=Q(changed=True)))
+        counts["states"] = {row["state"]: row["count"] for row in
+                            instance.events.values("state").annotate(count=Count("id")).order_by()}
+        return counts
+
+
+class MissionWithEventsSerializer(ShardIdsSerializerMixin, ModelSerializer):
+    repository = RepositorySerializer(read_only=True)
+    created_by = UserSerializer(read_only=True)
+    updated_by = UserSerializer(read_only=True)
+    summary = MissionSummarySerializer(read_only=True)
     events = MissionEventSerializer(read_only=True, many=True)
+    shard_ids = SerializerMethodField()
 
     class Meta:
         model = models.Mission
         fields = '__all__'
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.archived_at:
+            data["events"] = list(archive.read_events(instance))
+        return data
+
+
+class MissionOutputSerializer(Serializer):
+    offset = IntegerField()
+    next_offset = IntegerField()
+    size = IntegerField()
+    complete = BooleanField()
+    data = CharField()
+
+
+class RepositoryQueueSerializer(Serializer):
+    repository = IntegerField()
+    running = IntegerField()
+    pending = IntegerField()
+
+
+class MissionQueueSerializer(Serializer):
+    max_concurrent = IntegerField()
+    max_concurrent_per_repository = IntegerField()
+    running = IntegerField()
+    pending = IntegerField()
+    oldest_pending_at = DateTimeField(allow_null=True)
+    repositories = RepositoryQueueSerializer(many=True)
+
 
 class IntervalSerializer(ModelSerializer):
     class Meta:
@@ -170,7 +358,8 @@ class PeriodicMissionCreationSerializer(ModelSerializer):
 
     class Meta:
         model = models.PeriodicMission
-        fields = ["repository", "playbook", "inventories", "scheduler"]
+        fields = ["repository", "playbook", "inventories", "scheduler", "overlap_policy", "skip_unchanged",
+                  "converge_every", "profile"]
 
     def is_valid(self, raise_exception=False):
         if not super(PeriodicMissionCreationSerializer, self).is_valid(raise_exception):
@@ -206,4 +395,5 @@ class PeriodicMissionSerializer(ModelSerializer):
 class PeriodicMissionMutationSerializer(MutationSerializerMixin, PeriodicMissionCreationSerializer):
     class Meta:
         model = models.PeriodicMission
-        fields = ["repository", "playbook", "inventories", "scheduler"]
+        fields = ["repository", "playbook", "inventories", "scheduler", "overlap_policy", "skip_unchanged",
+                  "converge_every", "profile"]
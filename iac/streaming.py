@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from redis import asyncio as aioredis
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import BearerTokenAuthentication
+from .broker import client
+from .models import Mission, FINISHED_STATES
+
+logger = logging.getLogger(__name__)
+
+
+def stream_key(mission_id) -> str:
+    return f"codebox:mission:{mission_id}:stream"
+
+
+# 任务事件和状态写入redis stream, 各API进程的SSE连接从stream读取, 支持按stream id续传
+def publish(mission_id, items: list[tuple[str, dict]]):
+    if not items:
+        return
+    key = stream_key(mission_id)
+    try:
+        pipe = client().pipeline(transaction=False)
+        for kind, data in items:
+            pipe.xadd(key, {"type": kind, "data": json.dumps(data, default=str)},
+                      maxlen=settings.IAC_STREAM_MAXLEN, approximate=True)
+        pipe.expire(key, settings.IAC_STREAM_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("publish stream of mission %s failed: %s", mission_id, e)
+
+
+def publish_state(mission: Mission):
+    publish(mission.id, [("state", {"id": mission.id, "state": mission.state})])
+
+
+class MissionStreamApplication:
+    path = re.compile(r"^/api/iac/mission/(?P<id>\d+)/stream/$")
+    prefix = "bearer"
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        match = self.path.match(scope["path"]) if scope["type"] == "http" else None
+        if match is None:
+            return await self.application(scope, receive, send)
+        mission_id = int(match.group("id"))
+        headers = {name.decode().lower(): value.decode() for name, value in scope["headers"]}
+
+        if not await self.authenticate(headers.get("authorization", "")):
+            return await self.reply(send, 401, "authentication failed")
+        state = await sync_to_async(
+            lambda: Mission.objects.filter(id=mission_id).values_list("state", flat=True).first())()
+        if state is None:
+            return await self.reply(send, 404, "not found")
+
+        query = parse_qs(scope.get("query_string", b"").decode())
+        last_id = headers.get("last-event-id") or query.get("last_event_id", ["0-0"])[0]
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        await self.send_event(send, None, "state", json.dumps({"id": mission_id, "state": state}))
+
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        conn = aioredis.Redis.from_url(settings.CELERY_BROKER_URL)
+        try:
+            await self.forward(conn, send, mission_id, last_id, state in FINISHED_STATES, disconnected)
+        except aioredis.RedisError as e:
+            logger.warning("read stream of mission %s failed: %s", mission_id, e)
+        finally:
+            disconnected.cancel()
+            await conn.close()
+        await send({"type": "http.response.body", "body": b""})
+
+    async def forward(self, conn, send, mission_id, last_id, finished, disconnected):
+        # 已结束的任务只补发剩余记录
+        key = stream_key(mission_id)
+        block = None if finished else settings.IAC_STREAM_KEEPALIVE * 1000
+        while not disconnected.done():
+            response = await conn.xread({key: last_id}, count=500, block=block)
+            if not response:
+                if finished:
+                    return
+                await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                continue
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id.decode()
+                kind, data = fields[b"type"].decode(), fields[b"data"].decode()
+                await self.send_event(send, last_id, kind, data)
+                if kind == "state" and json.loads(data)["state"] in FINISHED_STATES:
+                    return
+
+    async def authenticate(self, header: str) -> bool:
+        if not header.lower().startswith(self.prefix):
+            return False
+        token = header[len(self.prefix):].strip().lower()
+        try:
+            await sync_to_async(BearerTokenAuthentication().authenticate_credentials)(token)
+        except AuthenticationFailed:
+            return False
+        return True
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    @staticmethod
+    async def send_event(send, event_id, kind, data):
+        lines = [f"id: {event_id}"] if event_id else []
+        lines += [f"event: {kind}", f"data: {data}", "", ""]
+        await send({"type": "http.response.body", "body": "\n".join(lines).encode(), "more_body": True})
+
+    @staticmethod
+    async def reply(send, status, message):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": json.dumps({"detail": message}).encode()})
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Sum
+
+from .db import upsert
+from .models import Mission, MissionHostSummary, MissionTaskSummary, MissionSummary
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ["ok", "changed", "failures", "unreachable", "skipped", "rescued", "ignored"]
+
+# playbook_on_stats中的统计项 -> 汇总字段
+STATS = {"ok": "ok", "changed": "changed", "failures": "failures", "dark": "unreachable",
+         "skipped": "skipped", "rescued": "rescued", "ignored": "ignored"}
+
+
+# 事件入库时增量维护任务/主机/task维度的汇总, 避免查询时扫描全部事件
+class SummaryCollector:
+    def __init__(self, mission: Mission):
+        self.mission = mission
+        self.flush_interval = settings.IAC_EVENT_FLUSH_INTERVAL
+        self.hosts: dict[str, MissionHostSummary] = {}
+        self.tasks: dict[str, MissionTaskSummary] = {}
+        self.dirty_hosts: set[str] = set()
+        self.dirty_tasks: set[str] = set()
+        self.flushed_at = time.monotonic()
+        self.lock = threading.RLock()
+
+    def host(self, name: str) -> MissionHostSummary:
+        if name not in self.hosts:
+            self.hosts[name] = MissionHostSummary(mission=self.mission, host=name)
+        self.dirty_hosts.add(name)
+        return self.hosts[name]
+
+    def add(self, event: dict):
+        with self.lock:
+            match event["event"]:
+                case "runner_on_ok" | "runner_on_failed" | "runner_on_unreachable" | "runner_on_skipped":
+                    self.add_result(event)
+                case "playbook_on_stats":
+                    self.add_stats(event["event_data"])
+                case _:
+                    return
+            if time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+
+    def add_result(self, event: dict):
+        data = event["event_data"]
+        host = self.host(data["host"])
+        res = data.get("res", {})
+        match event["event"]:
+            case "runner_on_ok":
+                host.ok += 1
+                if res.get("changed"):
+                    host.changed += 1
+            case "runner_on_failed":
+                if data.get("ignore_errors"):
+                    host.ignored += 1
+                else:
+                    host.failures += 1
+            case "runner_on_unreachable":
+                host.unreachable += 1
+            case "runner_on_skipped":
+                host.skipped += 1
+        duration = data.get("duration") or 0
+        host.duration += duration
+
+        uuid = event["parent_uuid"]
+        task = self.tasks.get(uuid)
+        if task is None:
+            task = self.tasks[uuid] = MissionTaskSummary(mission=self.mission, uuid=uuid, play=data["play"],
+                                                         task=data["task"], task_action=data["task_action"])
+        task.hosts += 1
+        task.total_duration += duration
+        task.max_duration = max(task.max_duration, duration)
+        self.dirty_tasks.add(uuid)
+
+    def add_stats(self, data: dict):
+        # 以ansible最终统计为准覆盖增量计数
+        names = set()
+        for key in STATS:
+            names.update(data.get(key) or {})
+        for name in names:
+            host = self.host(name)
+            for key, field in STATS.items():
+                setattr(host, field, (data.get(key) or {}).get(name, 0))
+
+    def flush(self):
+        with self.lock:
+            self.flushed_at = time.monotonic()
+            if not self.dirty_hosts and not self.dirty_tasks:
+                return
+            upsert(MissionHostSummary, [self.hosts[name] for name in self.dirty_hosts],
+                   unique_fields=["mission", "host"], update_fields=COUNTERS + ["duration"],
+                   batch_size=settings.IAC_EVENT_BATCH_SIZE)
+            upsert(MissionTaskSummary, [self.tasks[uuid] for uuid in self.dirty_tasks],
+                   unique_fields=["mission", "uuid"], update_fields=["hosts", "total_duration", "max_duration"],
+                   batch_size=settings.IAC_EVENT_BATCH_SIZE)
+            self.dirty_hosts, self.dirty_tasks = set(), set()
+            update_mission_summary(self.mission)
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("flush summary of mission %s failed", self.mission.id)
+
+
+def update_mission_summary(mission: Mission):
+    totals = MissionHostSummary.objects.filter(mission=mission) \
+        .aggregate(hosts=Count("id"), **{name: Sum(name) for name in COUNTERS})
+    MissionSummary.objects.update_or_create(mission=mission,
+                                            defaults={name: value or 0 for name, value in totals.items()})
@@ -1,27 +1,217 @@
-from celery import shared_task
+import logging
 
-from .models import Mission, MissionMode, PeriodicMission
+import redis
+from celery import shared_task, chord, group
+from celery.signals import worker_ready
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+from git import GitCommandError
+
+from . import archive, broker, ingestion, mirror, pool, scheduler, streaming, workdir
+from .mirror import remote_head
+from .models import Mission, MissionMode, MissionState, PeriodicMission, Authorization, OverlapPolicy, \
+    ACTIVE_STATES, inventory_hash
 from .runner import Runner
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def execute(mission_id):
+
+@shared_task(bind=True)
+def execute(self, mission_id):
     mission = Mission.objects.get(id=mission_id)
+    if mission.state == MissionState.CANCELING and (self.request.retries or mission.heartbeat_at is None):
+        # 派发后、开始执行前被取消
+        Mission.objects.filter(id=mission.id, state=MissionState.CANCELING) \
+            .update(state=MissionState.CANCELED, updated_at=timezone.now())
+        mission.state = MissionState.CANCELED
+        streaming.publish_state(mission)
+        if mission.mode != MissionMode.SHARD:
+            dispatch()
+        return
+    # 已取消、已结束或重复投递的任务不再执行
+    if self.request.retries == 0 and not scheduler.claim(mission):
+        return
+    if mission.state != MissionState.PENDING:
+        return
+    if workdir.under_pressure():
+        # 磁盘空间不足时先清理, 仍不足则延迟执行, 超过重试次数后任务失败
+        workdir.sweep()
+        if workdir.under_pressure():
+            if self.request.retries < settings.IAC_WORKDIR_MAX_RETRIES:
+                logger.warning("disk pressure on workdir, delay mission %s", mission_id)
+                Mission.objects.filter(id=mission.id).update(heartbeat_at=timezone.now())
+                raise self.retry(countdown=settings.IAC_WORKDIR_RETRY_DELAY)
+            mission.state = MissionState.FAILED
+            mission.output = "insufficient disk space for workdir\n"
+            mission.save()
+            streaming.publish_state(mission)
+            if mission.mode != MissionMode.SHARD:
+                dispatch()
+            return
     runner = Runner(mission)
-    runner.exec()
+    with runner.heartbeat():
+        if mission.shards > 1 and mission.mode != MissionMode.SHARD:
+            children = runner.shard()
+            if children:
+                # 分片任务异常退出时chord不会执行回调, 通过错误回调同样汇总并继续派发
+                chord(execute.si(child.id) for child in children)(
+                    collect.si(mission.id).on_error(collect.si(mission.id)))
+                return
+        else:
+            runner.exec()
+    if mission.mode != MissionMode.SHARD:
+        dispatch()
+
+
+@shared_task
+def collect(mission_id):
+    Runner.collect(Mission.objects.get(id=mission_id))
+    dispatch()
+
+
+@shared_task
+def dispatch():
+    # 直接调用时同步派发, 同时由beat定时触发兜底; 通过group一次发布
+    for mission in scheduler.reap():
+        Runner.collect(mission)
+    mission_ids = scheduler.schedule()
+    if mission_ids:
+        group(execute.si(mission_id) for mission_id in mission_ids).apply_async()
 
 
 @shared_task
 def submit(task_id):
     try:
         task = PeriodicMission.objects.get(uuid=task_id)
-        mission = Mission.objects.create(
+    except PeriodicMission.DoesNotExist:
+        return
+    # 同一定时任务的多次触发互斥, 保证检查上一次执行和创建新任务的原子性
+    try:
+        lock = broker.client().lock(f"codebox:schedule:{task.uuid.hex}", timeout=60, blocking_timeout=10)
+        acquired = lock.acquire()
+    except redis.RedisError as e:
+        logger.warning("acquire lock of schedule %s failed: %s", task.uuid, e)
+        return
+    if not acquired:
+        PeriodicMission.objects.filter(id=task.id).update(skipped=F("skipped") + 1)
+        return
+    try:
+        if not overlap(task):
+            return
+        digest = inventory_hash(task.inventories)
+        commit = unchanged(task, digest) if task.skip_unchanged else None
+        Mission.objects.create(
             repository=task.repository,
             playbook=task.playbook,
             inventories=task.inventories,
+            inventory_hash=digest,
+            profile=task.profile,
             mode=MissionMode.PERIODIC,
+            schedule=task,
+            # 未变化时只记录一次跳过的执行, 不克隆也不运行ansible
+            state=MissionState.SKIPPED if commit else MissionState.PENDING,
+            commit=commit,
             created_by=task.created_by
         )
-        execute.delay(mission.id)
-    except PeriodicMission.DoesNotExist:
-        pass
+        if commit:
+            return
+    finally:
+        try:
+            lock.release()
+        except redis.RedisError:
+            pass
+    dispatch()
+
+
+def overlap(task: PeriodicMission) -> bool:
+    # 按重叠策略处理上一次未结束的执行, 返回是否创建新任务
+    previous = list(task.missions.filter(state__in=ACTIVE_STATES))
+    if not previous or task.overlap_policy == OverlapPolicy.ALLOW:
+        return True
+    match task.overlap_policy:
+        case OverlapPolicy.SKIP:
+            PeriodicMission.objects.filter(id=task.id).update(skipped=F("skipped") + 1)
+            logger.info("skip schedule %s, previous mission still active", task.uuid)
+            return False
+        case OverlapPolicy.QUEUE_ONE:
+            # 只保留一个排队任务, 由调度器在上一次执行结束后派发
+            if any(mission.state == MissionState.PENDING and mission.dispatched_at is None for mission in previous):
+                PeriodicMission.objects.filter(id=task.id).update(coalesced=F("coalesced") + 1)
+                logger.info("coalesce schedule %s into queued mission", task.uuid)
+                return False
+        case OverlapPolicy.CANCEL_PREVIOUS:
+            for mission in previous:
+                Runner.cancel(mission)
+    return True
+
+
+def unchanged(task: PeriodicMission, digest: str) -> str | None:
+    # 远端HEAD与相同剧本和清单的上一次成功执行一致时返回该commit
+    last = Mission.objects.filter(repository=task.repository, playbook=task.playbook, inventory_hash=digest,
+                                  state=MissionState.COMPLETED, limit__isnull=True, parent__isnull=True) \
+        .order_by("-id").first()
+    if last is None or not last.commit:
+        return None
+    if task.converge_every and task.missions.filter(id__gt=last.id, state=MissionState.SKIPPED).count() \
+            >= task.converge_every:
+        return None
+    try:
+        head = remote_head(task.repository)
+    except GitCommandError as e:
+        logger.warning("ls-remote of repository %s failed: %s", task.repository.id, e)
+        return None
+    return head if head == last.commit else None
+
+
+@shared_task
+def purge_authorizations():
+    # 分批删除过期token, 避免长时间锁表
+    while True:
+        ids = list(Authorization.objects.filter(expired_at__lt=timezone.now())
+                   .values_list("id", flat=True)[:settings.IAC_PURGE_BATCH_SIZE])
+        if not ids:
+            break
+        Authorization.objects.filter(id__in=ids).delete()
+
+
+@shared_task
+def archive_missions():
+    for mission in archive.expired_missions():
+        try:
+            archive.archive(mission)
+        except Exception:
+            logger.exception("archive mission %s failed", mission.id)
+
+
+# 通过广播队列在每个worker上执行, 同一消息在各worker上的结果不需要保存
+@shared_task(ignore_result=True)
+def sweep_workdirs():
+    # 先补做导入, 导入完成的目录才能被清理
+    ingestion.recover()
+    workdir.sweep()
+
+
+# 镜像缓存在每台worker本地, 与清理工作目录一样广播到每个worker
+@shared_task(ignore_result=True)
+def evict_mirrors():
+    mirror.evict()
+
+
+@worker_ready.connect
+def recover_ingestion(**kwargs):
+    # worker重启后立即重新导入上次异常退出时遗留的job_events, 不等定时清理
+    try:
+        ingestion.recover()
+    except Exception:
+        logger.exception("recover ingestion failed")
+    finally:
+        # 主进程的数据库连接不能被之后fork的子进程复用
+        connections.close_all()
+
+
+# 预热目录在每台worker本地, 广播到每个worker
+@shared_task(ignore_result=True)
+def refresh_workdir_pool():
+    pool.refresh()
@@ -1,3 +1,199 @@
-from django.test import TestCase
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django_celery_beat.models import IntervalSchedule, PeriodicTask, CrontabSchedule
+from rest_framework.test import APIClient
+
+from .db import upsert
+from .output import OutputWriter, read
+from .scheduler import select
+from .models import Repository, Mission, MissionEvent, MissionHostSummary, MissionMode, PeriodicMission
+
+
+class QueryCountTest(TestCase):
+    size = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser("admin", "admin@example.com", "admin")
+        for i in range(cls.size):
+            user = User.objects.create_user(f"user{i}")
+            repository = Repository.objects.create(name=f"repository{i}", url="https://example.com/repo.git",
+                                                   created_by=user, updated_by=user)
+            mission = Mission.objects.create(repository=repository, playbook="playbook.yaml",
+                                             created_by=user, updated_by=user)
+            for host in range(cls.size):
+                MissionEvent.objects.create(mission=mission, state="ok", uuid=uuid.uuid4(), host=f"host{host}",
+                                            play="demo", play_pattern="all", task="ping",
+                                            task_action="ping", task_args="", res={"changed": False})
+            if i % 2:
+                interval = IntervalSchedule.objects.create(every=10, period=IntervalSchedule.SECONDS)
+                scheduler = PeriodicTask.objects.create(name=f"task{i}", task="iac.tasks.submit", interval=interval)
+            else:
+                crontab = CrontabSchedule.objects.create(minute="*/5")
+                scheduler = PeriodicTask.objects.create(name=f"task{i}", task="iac.tasks.submit", crontab=crontab)
+            PeriodicMission.objects.create(repository=repository, playbook="playbook.yaml", uuid=uuid.uuid4(),
+                                           scheduler=scheduler, created_by=user, updated_by=user)
+        cls.mission = Mission.objects.first()
+        cls.periodic_mission = PeriodicMission.objects.first()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def assertQueries(self, num, path):
+        with self.assertNumQueries(num):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_list_repositories(self):
+        self.assertQueries(2, "/api/iac/repository/")
+
+    def test_retrieve_repository(self):
+        self.assertQueries(1, f"/api/iac/repository/{self.mission.repository_id}/")
+
+    def test_list_missions(self):
+        self.assertQueries(2, "/api/iac/mission/")
+
+    def test_list_missions_keyset(self):
+        self.assertQueries(1, "/api/iac/mission/?cursor=&count=false")
+
+    def test_retrieve_mission(self):
+        self.assertQueries(2, f"/api/iac/mission/{self.mission.id}/")
+
+    def test_retrieve_mission_summary(self):
+        self.assertQueries(3, f"/api/iac/mission/{self.mission.id}/?summary=true")
+
+    def test_retrieve_sharded_mission(self):
+        parent = Mission.objects.create(repository=self.mission.repository, playbook="playbook.yaml", shards=2)
+        children = [Mission.objects.create(repository=parent.repository, playbook="playbook.yaml",
+                                           mode=MissionMode.SHARD, parent=parent) for _ in range(2)]
+        with self.assertNumQueries(3):
+            response = self.client.get(f"/api/iac/mission/{parent.id}/")
+        self.assertEqual(response.json()["shard_ids"], [child.id for child in children])
+
+    def test_mission_stats(self):
+        self.assertQueries(3, f"/api/iac/mission/{self.mission.id}/stats/")
+
+    def test_list_mission_events(self):
+        self.assertQueries(2, f"/api/iac/mission/{self.mission.id}/events/")
+
+    def test_list_periodic_missions(self):
+        self.assertQueries(2, "/api/iac/schedule/")
+
+    def test_retrieve_periodic_mission(self):
+        self.assertQueries(1, f"/api/iac/schedule/{self.periodic_mission.id}/")
+
+
+class UpsertTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        repository = Repository.objects.create(name="repository", url="https://example.com/repo.git")
+        cls.mission = Mission.objects.create(repository=repository, playbook="playbook.yaml")
+
+    def event(self, uuid_, host, state, changed):
+        return MissionEvent(mission=self.mission, uuid=uuid_, host=host, state=state, play="demo",
+                            play_pattern="all", task="ping", task_action="ping", task_args="",
+                            res={"changed": changed}, changed=changed)
+
+    def test_upsert_events(self):
+        task = uuid.uuid4()
+        fields = ["state", "res", "changed"]
+        upsert(MissionEvent, [self.event(task, "host0", "start", False), self.event(task, "host1", "start", False)],
+               unique_fields=["mission", "uuid", "host"], update_fields=fields)
+        upsert(MissionEvent, [self.event(task, "host0", "ok", True)],
+               unique_fields=["mission", "uuid", "host"], update_fields=fields)
+        events = {event.host: event for event in MissionEvent.objects.filter(mission=self.mission, uuid=task)}
+        self.assertEqual(len(events), 2)
+        self.assertEqual((events["host0"].state, events["host0"].changed, events["host0"].res),
+                         ("ok", True, {"changed": True}))
+        self.assertEqual((events["host1"].state, events["host1"].changed), ("start", False))
+
+    def test_upsert_host_summaries(self):
+        fields = ["ok", "changed", "failures", "duration"]
+        upsert(MissionHostSummary, [MissionHostSummary(mission=self.mission, host="host0", ok=1, duration=0.5)],
+               unique_fields=["mission", "host"], update_fields=fields)
+        upsert(MissionHostSummary, [MissionHostSummary(mission=self.mission, host="host0", ok=2, changed=1,
+                                                       failures=1, duration=1.5)],
+               unique_fields=["mission", "host"], update_fields=fields)
+        summaries = MissionHostSummary.objects.filter(mission=self.mission, host="host0")
+        self.assertEqual(summaries.count(), 1)
+        self.assertEqual(summaries.values_list("ok", "changed", "failures", "duration").get(), (2, 1, 1, 1.5))
+
+
+@override_settings(IAC_OUTPUT_CHUNK_SIZE=7)
+class OutputTest(TestCase):
+    text = "hello 世界"
+
+    @classmethod
+    def setUpTestData(cls):
+        repository = Repository.objects.create(name="repository", url="https://example.com/repo.git")
+        cls.mission = Mission.objects.create(repository=repository, playbook="playbook.yaml")
+
+    def setUp(self):
+        writer = OutputWriter(self.mission)
+        writer.write(self.text)
+        writer.close()
+
+    def test_read_across_boundaries(self):
+        # 分块和单次读取上限都落在多字节字符中间
+        data, offset = "", 0
+        while True:
+            result = read(self.mission, offset=offset, limit=5)
+            self.assertEqual(result["offset"], offset)
+            if result["next_offset"] == offset:
+                break
+            data += result["data"]
+            offset = result["next_offset"]
+        self.assertEqual(data, self.text)
+        self.assertEqual(offset, len(self.text.encode()))
+
+    def test_read_from_middle_of_character(self):
+        result = read(self.mission, tail=4)
+        self.assertEqual((result["offset"], result["data"]), (9, "界"))
+        self.assertEqual(read(self.mission, offset=6, limit=1)["data"], "世")
+
+
+@override_settings(IAC_MAX_CONCURRENT_MISSIONS=10, IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY=10)
+class SelectTest(SimpleTestCase):
+    def queue(self, *missions):
+        # (repository, priority[, shards]), 按调度器查询的顺序排序
+        created = datetime(2022, 1, 1)
+        queued = [SimpleNamespace(id=i, repository_id=repository, priority=priority, shards=shards[0] if shards else 1,
+                                  created_at=created + timedelta(seconds=i))
+                  for i, (repository, priority, *shards) in enumerate(missions)]
+        return sorted(queued, key=lambda mission: (-mission.priority, mission.created_at, mission.id))
+
+    def test_round_robin(self):
+        queued = self.queue((1, 0), (1, 0), (1, 0), (2, 0), (2, 0), (3, 0))
+        self.assertEqual([mission.id for mission in select(queued, {})], [0, 3, 5, 1, 4, 2])
+
+    @override_settings(IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY=2)
+    def test_repository_cap(self):
+        queued = self.queue((1, 0), (1, 0), (1, 0), (2, 0), (2, 0), (2, 0))
+        self.assertEqual([mission.id for mission in select(queued, {1: 1})], [0, 3, 4])
+
+    @override_settings(IAC_MAX_CONCURRENT_MISSIONS=3)
+    def test_global_cap(self):
+        queued = self.queue((1, 0), (1, 0), (2, 0), (2, 0))
+        self.assertEqual([mission.id for mission in select(queued, {3: 1})], [0, 2])
+        self.assertEqual(select(queued, {3: 3}), [])
+
+    def test_priority(self):
+        queued = self.queue((1, 0), (1, 5), (2, 1), (1, 1))
+        # 仓库内按优先级, 每轮各仓库队首按优先级排序
+        self.assertEqual([mission.id for mission in select(queued, {})], [1, 2, 3, 0])
+
+    @override_settings(IAC_MAX_CONCURRENT_MISSIONS=6)
+    def test_shards_take_slots(self):
+        # 分片任务放不下时停止派发, 后面的小任务不能插队
+        queued = self.queue((1, 1, 4), (2, 0, 4), (3, 0))
+        self.assertEqual([mission.id for mission in select(queued, {})], [0])
+
+    @override_settings(IAC_MAX_CONCURRENT_MISSIONS_PER_REPOSITORY=4)
+    def test_shards_repository_cap(self):
+        queued = self.queue((1, 0, 3), (1, 0), (2, 0))
+        self.assertEqual([mission.id for mission in select(queued, {1: 2})], [2])
@@ -1,13 +1,15 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from .views import MissionViewSet, RepositoryViewSet, AuthorizationViewSet, PeriodicMissionViewSet
+from .views import MissionViewSet, RepositoryViewSet, AuthorizationViewSet, PeriodicMissionViewSet, \
+    ExecutionProfileViewSet
 
 router = DefaultRouter()
 router.register(r'mission', MissionViewSet, basename="mission")
 router.register(r'repository', RepositoryViewSet, basename="repository")
 router.register(r'auth', AuthorizationViewSet, basename="auth")
 router.register(r'schedule', PeriodicMissionViewSet, basename='schedule')
+router.register(r'profile', ExecutionProfileViewSet, basename='profile')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,4 +1,8 @@
+import uuid
+from collections import OrderedDict
+
 from django.db import transaction
+from django.db.models import Sum, Max, ProtectedError
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework import status
@@ -6,12 +10,17 @@ from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.viewsets import GenericViewSet
 
-from .models import Mission, Repository, Authorization, PeriodicMission
+from . import archive, output, scheduler
+from .facts import FactCache
+from .models import Mission, Repository, Authorization, PeriodicMission, MissionMode, ExecutionProfile, \
+    FINISHED_STATES
+from .pagination import MissionEventCursorPagination, KeysetResultSetPagination
 from .runner import Runner
 from .serializers import *
-from .tasks import execute
+from .tasks import dispatch
 
 
 @extend_schema(tags=["Auth"])
@@ -31,25 +40,63 @@ class AuthorizationViewSet(GenericViewSet):
     @extend_schema("logout", request=None, responses=None)
     @action(methods=["put"], detail=False)
     def logout(self, request: Request, *args, **kwargs):
-        try:
-            Authorization.objects.filter(token=request.auth).delete()
-        except Authorization.DoesNotExist:
-            pass
+        # 删除时由信号清除token缓存
+        Authorization.objects.filter(token=request.auth).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @extend_schema("logoutAll", request=None, responses=None)
-    @action(methods=["delete"], detail=False)
-    def logout(self, request: Request, *args, **kwargs):
+    @logout.mapping.delete
+    def logout_all(self, request: Request, *args, **kwargs):
+        Authorization.objects.filter(user=request.user).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@extend_schema(tags=["IacExecutionProfile"])
+class ExecutionProfileViewSet(GenericViewSet):
+    queryset = ExecutionProfile.objects.select_related("created_by", "updated_by").order_by("id")
+    serializer_class = ExecutionProfileSerializer
+
+    @extend_schema("createExecutionProfile", request=ExecutionProfileCreationSerializer,
+                   responses=ExecutionProfileSerializer)
+    def create(self, request, *args, **kwargs):
+        serializer = ExecutionProfileCreationSerializer(data=request.data)
+        if serializer.is_valid():
+            serializer.save(created_by=request.user)
+            return Response(ExecutionProfileSerializer(serializer.instance).data)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @extend_schema("listExecutionProfiles", responses=ExecutionProfileSerializer(many=True))
+    def list(self, request, *args, **kwargs):
+        res = self.paginate_queryset(self.queryset)
+        serializer = ExecutionProfileSerializer(res, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @extend_schema("getExecutionProfile", responses=ExecutionProfileSerializer)
+    def retrieve(self, request, *args, **kwargs):
+        serializer = ExecutionProfileSerializer(self.get_object())
+        return Response(serializer.data)
+
+    @extend_schema("updateExecutionProfile", responses=ExecutionProfileSerializer,
+                   request=ExecutionProfileMutationSerializer)
+    def update(self, request, *args, **kwargs):
+        serializer = ExecutionProfileMutationSerializer(self.get_object(), data=request.data)
+        if serializer.is_valid():
+            serializer.save(updated_by=request.user)
+            return Response(ExecutionProfileSerializer(serializer.instance).data)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    @extend_schema("deleteExecutionProfile", responses=None)
+    def destroy(self, request, *args, **kwargs):
         try:
-            Authorization.objects.filter(user=request.user).delete()
-        except Authorization.DoesNotExist:
-            pass
+            self.get_object().delete()
+        except ProtectedError:
+            return Response(data={"detail": "profile is in use"}, status=status.HTTP_400_BAD_REQUEST)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 @extend_schema(tags=["IacRepository"])
 class RepositoryViewSet(GenericViewSet):
-    queryset = Repository.objects.all().order_by("id")
+    queryset = Repository.objects.select_related("created_by", "updated_by").order_by("id")
     serializer_class = RepositorySerializer
 
     @extend_schema("createRepository", request=RepositoryCreationSerializer,
@@ -80,22 +127,81 @@ class RepositoryViewSet(GenericViewSet):
             return Response(RepositorySerializer(serializer.instance).data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def fact_cache(self) -> FactCache:
+        repository = self.get_object()
+        profile = repository.profile
+        return FactCache(repository, profile.fact_cache_timeout if profile else None)
+
+    @extend_schema("listRepositoryFacts", responses=FactCacheHostSerializer(many=True))
+    @action(methods=["get"], detail=True)
+    def facts(self, request, *args, **kwargs):
+        return Response(data=FactCacheHostSerializer(self.fact_cache().hosts(), many=True).data)
+
+    @extend_schema("flushRepositoryFacts", responses=None)
+    @facts.mapping.delete
+    def flush_facts(self, request, *args, **kwargs):
+        self.fact_cache().flush()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @extend_schema("getHostFacts", responses=HostFactsSerializer)
+    @action(methods=["get"], detail=True, url_path=r"facts/(?P<host>[^/]+)")
+    def host_facts(self, request, host, *args, **kwargs):
+        facts = self.fact_cache().get(host)
+        if facts is None:
+            return Response(data={"detail": "not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data=HostFactsSerializer(facts).data)
+
+    @extend_schema("flushHostFacts", responses=None)
+    @host_facts.mapping.delete
+    def flush_host_facts(self, request, host, *args, **kwargs):
+        self.fact_cache().delete(host)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 @extend_schema(tags=["IacMission"])
 class MissionViewSet(GenericViewSet):
-    queryset = Mission.objects.all()
+    queryset = Mission.objects.select_related("repository__created_by", "repository__updated_by",
+                                              "created_by", "updated_by", "summary")
     serializer_class = MissionSerializer
+    pagination_class = KeysetResultSetPagination
 
     @extend_schema("createMission", request=MissionCreationSerializer, responses=MissionSerializer)
     def create(self, request, *args, **kwargs):
         serializer = MissionCreationSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save(created_by=request.user)
-            execute.delay(serializer.instance.id)
+            dispatch.delay()
             # Runner(serializer.instance).run()
             return Response(data=MissionSerializer(serializer.instance).data)
         return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @extend_schema("bulkCreateMissions", request=MissionBulkCreationSerializer, responses=MissionBulkSerializer)
+    @action(methods=["post"], detail=False, url_path="bulk")
+    def bulk_create(self, request, *args, **kwargs):
+        serializer = MissionBulkCreationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        batch = uuid.uuid4()
+        Mission.objects.bulk_create([Mission(batch=batch, created_by=request.user, **item)
+                                     for item in serializer.validated_data["missions"]], batch_size=500)
+        # mysql的bulk_create不返回主键, 按批次号查询
+        ids = list(Mission.objects.filter(batch=batch).order_by("id").values_list("id", flat=True))
+        dispatch.delay()
+        return Response(data=MissionBulkSerializer({"batch": batch, "ids": ids}).data)
+
+    @extend_schema("bulkCancelMissions", request=MissionBulkCancelSerializer, responses=None)
+    @action(methods=["put"], detail=False, url_path="bulk/cancel")
+    def bulk_cancel(self, request, *args, **kwargs):
+        serializer = MissionBulkCancelSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        missions = Mission.objects.all()
+        if serializer.validated_data.get("batch"):
+            missions = missions.filter(batch=serializer.validated_data["batch"])
+        if serializer.validated_data.get("ids"):
+            missions = missions.filter(id__in=serializer.validated_data["ids"])
+        return Response(data={"canceled": Runner.cancel_many(missions)})
+
     @extend_schema("cancelMission", request=None, responses=MissionSerializer)
     @action(methods=["put"], detail=True)
     def cancel(self, request, *args, **kwargs):
@@ -103,10 +209,28 @@ class MissionViewSet(GenericViewSet):
         Runner.cancel(instance)
         return Response(data=MissionSerializer(instance).data)
 
+    @extend_schema("retryMission", request=None, responses=MissionSerializer)
+    @action(methods=["post"], detail=True)
+    def retry(self, request, *args, **kwargs):
+        instance = self.get_object()
+        if instance.mode == MissionMode.SHARD or instance.state not in FINISHED_STATES:
+            return Response(data={"detail": "only finished missions can be retried"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        mission = Runner.retry(instance, request.user)
+        if mission is None:
+            return Response(data={"detail": "no failed or unreachable hosts"}, status=status.HTTP_400_BAD_REQUEST)
+        dispatch.delay()
+        return Response(data=MissionSerializer(mission).data)
+
+    @extend_schema("getMissionQueue", request=None, responses=MissionQueueSerializer)
+    @action(methods=["get"], detail=False)
+    def queue(self, request, *args, **kwargs):
+        return Response(data=MissionQueueSerializer(scheduler.stats()).data)
+
     @extend_schema("listMissions", responses=MissionSerializer(many=True),
                    parameters=[OpenApiParameter(name="repository", type=OpenApiTypes.INT64)])
     def list(self, request: Request, *args, **kwargs):
-        queryset = self.queryset
+        queryset = self.queryset.exclude(mode=MissionMode.SHARD)
         repository = request.query_params.get("repository")
         if repository:
             queryset = queryset.filter(repository__id=repository)
@@ -114,15 +238,107 @@ class MissionViewSet(GenericViewSet):
         serializer = MissionSerializer(instance=res, many=True)
         return self.get_paginated_response(serializer.data)
 
-    @extend_schema("getMission", responses=MissionWithEventsSerializer)
+    @extend_schema("getMissionOutput", responses=MissionOutputSerializer,
+                   parameters=[OpenApiParameter(name="offset", type=OpenApiTypes.INT64),
+                               OpenApiParameter(name="tail", type=OpenApiTypes.INT64),
+                               OpenApiParameter(name="limit", type=OpenApiTypes.INT64)])
+    @action(methods=["get"], detail=True)
+    def output(self, request: Request, *args, **kwargs):
+        params = {}
+        for name in ("offset", "tail", "limit"):
+            value = request.query_params.get(name)
+            if value is not None:
+                if not value.isdigit():
+                    return Response(data={name: "must be a non-negative integer"},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                params[name] = int(value)
+        data = output.read(self.get_object(), **params)
+        return Response(data=MissionOutputSerializer(data).data)
+
+    @extend_schema("listMissionEvents", responses=MissionEventListSerializer(many=True),
+                   parameters=[OpenApiParameter(name="host", type=OpenApiTypes.STR),
+                               OpenApiParameter(name="state", type=OpenApiTypes.STR),
+                               OpenApiParameter(name="changed", type=OpenApiTypes.BOOL),
+                               OpenApiParameter(name="task", type=OpenApiTypes.STR),
+                               OpenApiParameter(name="fields", type=OpenApiTypes.STR,
+                                                description="comma separated fields, res is excluded by default"),
+                               OpenApiParameter(name="after", type=OpenApiTypes.INT64,
+                                                description="page cursor of archived missions")])
+    @action(methods=["get"], detail=True, pagination_class=MissionEventCursorPagination)
+    def events(self, request: Request, *args, **kwargs):
+        instance = self.get_object()
+        filters = {}
+        for name in ("host", "state", "task"):
+            value = request.query_params.get(name)
+            if value:
+                filters[name] = value
+        changed = request.query_params.get("changed")
+        if changed:
+            filters["changed"] = changed.lower() in ("1", "true")
+        fields = request.query_params.get("fields")
+        fields = fields.split(",") if fields else None
+        if instance.archived_at:
+            return self.archived_events(request, instance, filters, fields)
+
+        queryset = instance.events.filter(**filters)
+        if not fields or "res" not in fields:
+            queryset = queryset.defer("res")
+        res = self.paginate_queryset(queryset)
+        serializer = MissionEventListSerializer(instance=res, many=True, context={"request": request})
+        return self.get_paginated_response(serializer.data)
+
+    def archived_events(self, request: Request, instance: Mission, filters: dict, fields: list):
+        # 已归档任务从归档文件顺序读取, 按事件id翻页
+        after = request.query_params.get("after", "")
+        after = int(after) if after.isdigit() else 0
+        size = self.paginator.get_page_size(request)
+        results = []
+        for event in archive.read_events(instance):
+            if event["id"] <= after or any(event[name] != value for name, value in filters.items()):
+                continue
+            results.append({name: value for name, value in event.items()
+                            if (name in fields if fields else name != "res")})
+            if len(results) > size:
+                break
+        next_url = None
+        if len(results) > size:
+            results = results[:size]
+            next_url = replace_query_param(request.build_absolute_uri(), "after", event["id"] - 1)
+        return Response(OrderedDict([("next", next_url), ("previous", None), ("results", results)]))
+
+    @extend_schema("getMissionStats", responses=MissionStatsSerializer,
+                   parameters=[OpenApiParameter(name="top", type=OpenApiTypes.INT,
+                                                description="number of slowest tasks, default 20")])
+    @action(methods=["get"], detail=True)
+    def stats(self, request: Request, *args, **kwargs):
+        instance = self.get_object()
+        top = request.query_params.get("top", "20")
+        top = int(top) if top.isdigit() else 20
+        data = {
+            "hosts": instance.host_summaries.order_by("host"),
+            # 分片任务的同一task有多条汇总, 按task合并
+            "tasks": instance.task_summaries.values("play", "task", "task_action")
+            .annotate(hosts=Sum("hosts"), total_duration=Sum("total_duration"), max_duration=Max("max_duration"))
+            .order_by("-total_duration")[:top],
+        }
+        return Response(data=MissionStatsSerializer(data).data)
+
+    @extend_schema("getMission", responses=MissionWithEventsSerializer,
+                   parameters=[OpenApiParameter(name="summary", type=OpenApiTypes.BOOL,
+                                                description="return event counts instead of events")])
     def retrieve(self, request, *args, **kwargs):
-        serializer = MissionWithEventsSerializer(self.get_object())
+        if request.query_params.get("summary", "").lower() in ("1", "true"):
+            serializer = MissionWithEventCountsSerializer(self.get_object())
+        else:
+            serializer = MissionWithEventsSerializer(self.get_object())
         return Response(serializer.data)
 
 
 @extend_schema(tags=["PeriodicMission"])
 class PeriodicMissionViewSet(GenericViewSet):
-    queryset = PeriodicMission.objects.all()
+    queryset = PeriodicMission.objects.select_related("repository__created_by", "repository__updated_by",
+                                                      "created_by", "updated_by",
+                                                      "scheduler__interval", "scheduler__crontab")
     serializer_class = PeriodicMissionSerializer
 
     @extend_schema("createPeriodicMission", request=PeriodicMissionCreationSerializer,
@@ -0,0 +1,148 @@
+import fnmatch
+import logging
+import pathlib
+import shutil
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .mirror import _size
+from .models import Mission, FINISHED_STATES
+
+logger = logging.getLogger(__name__)
+
+
+def root() -> pathlib.Path:
+    return pathlib.Path(settings.IAC_WORKDIR)
+
+
+def path(mission_id) -> pathlib.Path:
+    return root().joinpath(str(mission_id))
+
+
+def pool_root() -> pathlib.Path:
+    return root().joinpath("pool")
+
+
+def clear(mission_id) -> pathlib.Path:
+    # 新库中任务id可能与遗留目录重复
+    workdir = path(mission_id)
+    if workdir.exists():
+        logger.warning("remove stale workdir %s", workdir)
+        remove(workdir)
+    return workdir
+
+
+def create(mission_id) -> pathlib.Path:
+    workdir = clear(mission_id)
+    workdir.mkdir(parents=True)
+    return workdir
+
+
+def remove(workdir: pathlib.Path) -> int:
+    size = _size(workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+    metrics.WORKDIR_RECLAIMED.inc(size)
+    return size
+
+
+# 延迟入库的任务执行前和事件写入失败时在工作目录中标记, 导入完成后随清理删除;
+# worker异常退出时标记保留, 定时清理跳过该目录, 由本机的ingestion.recover重新导入
+PENDING_INGESTION = ".ingestion-pending"
+
+
+def mark_pending(mission_id):
+    path(mission_id).joinpath(PENDING_INGESTION).touch()
+
+
+def ingestion_pending(workdir: pathlib.Path) -> bool:
+    return workdir.joinpath(PENDING_INGESTION).exists()
+
+
+def usage() -> float:
+    root().mkdir(parents=True, exist_ok=True)
+    disk = shutil.disk_usage(root())
+    return disk.used / disk.total
+
+
+def under_pressure() -> bool:
+    return usage() >= settings.IAC_WORKDIR_HIGH_WATERMARK
+
+
+def retained(name: str) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in settings.IAC_WORKDIR_RETAIN_ARTIFACTS)
+
+
+# 任务结束后只保留artifacts/<ident>/下配置的文件, 其余(仓库副本, 清单等)全部删除
+def cleanup(mission_id) -> int:
+    workdir = path(mission_id)
+    if not workdir.exists():
+        return 0
+    reclaimed = 0
+    for child in workdir.iterdir():
+        if child.name == "artifacts" and child.is_dir():
+            for ident in child.iterdir():
+                for item in (ident.iterdir() if ident.is_dir() else [ident]):
+                    if not retained(item.relative_to(ident).as_posix()):
+                        reclaimed += remove_path(item)
+                if ident.is_dir() and not any(ident.iterdir()):
+                    ident.rmdir()
+            if not any(child.iterdir()):
+                child.rmdir()
+        else:
+            reclaimed += remove_path(child)
+    if not any(workdir.iterdir()):
+        workdir.rmdir()
+    if reclaimed:
+        logger.info("cleanup workdir of mission %s, reclaimed %d bytes", mission_id, reclaimed)
+    return reclaimed
+
+
+def remove_path(item: pathlib.Path) -> int:
+    if item.is_dir() and not item.is_symlink():
+        return remove(item)
+    size = item.lstat().st_size
+    item.unlink(missing_ok=True)
+    metrics.WORKDIR_RECLAIMED.inc(size)
+    return size
+
+
+# 定时清理: 删除已结束任务超过保留时间的目录, 补做异常退出时遗漏的清理; 磁盘超过高水位时从旧到新删除直到低水位
+def sweep() -> int:
+    started = time.monotonic()
+    if not root().exists():
+        return 0
+    workdirs = {int(p.name): p for p in root().iterdir() if p.name.isdigit() and p.is_dir()}
+    states = dict(Mission.objects.filter(id__in=workdirs).values_list("id", "state"))
+    expire = time.time() - settings.IAC_WORKDIR_RETAIN_HOURS * 3600
+    reclaimed = 0
+    finished = []
+    for mission_id, workdir in workdirs.items():
+        if mission_id in states and states[mission_id] not in FINISHED_STATES:
+            continue
+        if mission_id in states and ingestion_pending(workdir):
+            logger.warning("skip workdir %s, events are pending ingestion", workdir)
+            continue
+        try:
+            modified = workdir.stat().st_mtime
+            if mission_id not in states or modified < expire:
+                reclaimed += remove(workdir)
+            else:
+                reclaimed += cleanup(mission_id)
+                finished.append((modified, workdir))
+        except OSError as e:
+            logger.warning("sweep workdir %s failed: %s", workdir, e)
+
+    # 磁盘压力下优先释放预热目录
+    if pool_root().exists() and usage() >= settings.IAC_WORKDIR_HIGH_WATERMARK:
+        reclaimed += remove(pool_root())
+    for _, workdir in sorted(finished):
+        if usage() < settings.IAC_WORKDIR_LOW_WATERMARK:
+            break
+        if workdir.exists():
+            reclaimed += remove(workdir)
+    duration = time.monotonic() - started
+    metrics.WORKDIR_SWEEP_DURATION.observe(duration)
+    logger.info("sweep workdirs reclaimed %d bytes in %.2fs", reclaimed, duration)
+    return reclaimed